@@ -0,0 +1,455 @@
+/*
+ * Compiled implementation of read_form and to_frame from sexp.py.
+ *
+ * sexp.py picks this module up if it finds it next to itself and falls back to pure Python otherwise,
+ * so shipping it is optional. Semantics are exactly those of the Python codec, which is the reference:
+ * `python sexp.py` runs the conformance checks against both implementations.
+ * Only unicode input is read here; byte strings and relaxed mode (.ensime files) are handed over to Python.
+ *
+ * The module has to be built against the interpreter that runs the plugin
+ * (Python 2.6 embedded into Sublime Text 2, or a compatible 2.x for testing), e.g.:
+ *
+ *   Linux:   gcc -shared -fPIC -O2 -fno-strict-aliasing -I/usr/include/python2.6 _sexp_speedups.c -o _sexp_speedups.so
+ *   OS X:    gcc -bundle -undefined dynamic_lookup -O2 -fno-strict-aliasing -I/usr/include/python2.6 _sexp_speedups.c -o _sexp_speedups.so
+ *   Windows: cl /LD /O2 /IC:\Python26\include _sexp_speedups.c C:\Python26\libs\python26.lib /Fe_sexp_speedups.pyd
+ *
+ * Then run `python sexp.py`, which checks the compiled codec against the pure Python one.
+ */
+
+#include <Python.h>
+
+#if PY_VERSION_HEX < 0x02050000
+typedef int Py_ssize_t;
+#endif
+
+static PyObject *keyword_cls = NULL;
+static PyObject *symbol_cls = NULL;
+static PyObject *py_read_form = NULL;
+
+/* ============================== READER ============================== */
+
+static PyObject *
+syntax_error(const char *message)
+{
+  PyErr_SetString(PyExc_SyntaxError, message);
+  return NULL;
+}
+
+static PyObject *
+syntax_error_with(const char *message, PyObject *detail)
+{
+  PyObject *prefix = PyUnicode_FromString(message);
+  PyObject *full;
+  if (!prefix) return NULL;
+  full = PyUnicode_Concat(prefix, detail);
+  Py_DECREF(prefix);
+  if (!full) return NULL;
+  PyErr_SetObject(PyExc_SyntaxError, full);
+  Py_DECREF(full);
+  return NULL;
+}
+
+/* the message is unicode-escaped like in sexp.py, because exceptions with non-ascii messages can't be printed */
+static PyObject *
+malformed_int(PyObject *group)
+{
+  PyObject *escaped = PyUnicode_AsUnicodeEscapeString(group);
+  if (!escaped) return NULL;
+  PyErr_Format(PyExc_SyntaxError, "malformed int: %s", PyString_AS_STRING(escaped));
+  Py_DECREF(escaped);
+  return NULL;
+}
+
+static PyObject *
+slice(const Py_UNICODE *s, Py_ssize_t begin, Py_ssize_t end)
+{
+  return PyUnicode_FromUnicode(s + begin, end - begin);
+}
+
+static Py_ssize_t
+find(const Py_UNICODE *s, Py_UNICODE ch, Py_ssize_t begin, Py_ssize_t end)
+{
+  Py_ssize_t i;
+  for (i = begin; i < end; i++)
+    if (s[i] == ch) return i;
+  return -1;
+}
+
+static PyObject *
+intern_string(PyObject *val, PyObject *pool)
+{
+  PyObject *pooled;
+  if (!val || pool == Py_None) return val;
+  switch (PyObject_IsTrue(pool)) {
+    case 0: return val;
+    case -1: Py_DECREF(val); return NULL;
+  }
+  pooled = PyObject_CallMethod(pool, "intern", "O", val);
+  Py_DECREF(val);
+  return pooled;
+}
+
+static PyObject *
+read_string(const Py_UNICODE *s, Py_ssize_t n, Py_ssize_t *ppos, PyObject *pool)
+{
+  Py_ssize_t pos = *ppos + 1, end, escape;
+  PyObject *chunks, *chunk, *empty, *val;
+
+  end = find(s, '"', pos, n);
+  if (end == -1) return syntax_error("EOF while reading string");
+  escape = find(s, '\\', pos, end);
+  if (escape == -1) {
+    *ppos = end + 1;
+    return intern_string(slice(s, pos, end), pool);
+  }
+  /* slow path: copy the string chunk by chunk between escapes */
+  chunks = PyList_New(0);
+  if (!chunks) return NULL;
+  while (escape != -1) {
+    if (escape + 1 >= n) { Py_DECREF(chunks); return syntax_error("EOF while reading string"); }
+    chunk = slice(s, pos, escape);
+    if (!chunk || PyList_Append(chunks, chunk) < 0) { Py_XDECREF(chunk); Py_DECREF(chunks); return NULL; }
+    Py_DECREF(chunk);
+    chunk = slice(s, escape + 1, escape + 2);
+    if (!chunk || PyList_Append(chunks, chunk) < 0) { Py_XDECREF(chunk); Py_DECREF(chunks); return NULL; }
+    Py_DECREF(chunk);
+    pos = escape + 2;
+    if (end < pos) {
+      end = find(s, '"', pos, n);
+      if (end == -1) { Py_DECREF(chunks); return syntax_error("EOF while reading string"); }
+    }
+    escape = find(s, '\\', pos, end);
+  }
+  chunk = slice(s, pos, end);
+  if (!chunk || PyList_Append(chunks, chunk) < 0) { Py_XDECREF(chunk); Py_DECREF(chunks); return NULL; }
+  Py_DECREF(chunk);
+  empty = PyUnicode_FromUnicode(NULL, 0);
+  if (!empty) { Py_DECREF(chunks); return NULL; }
+  val = PyUnicode_Join(empty, chunks);
+  Py_DECREF(empty);
+  Py_DECREF(chunks);
+  *ppos = end + 1;
+  return intern_string(val, pool);
+}
+
+static PyObject *
+read_atom(const Py_UNICODE *s, Py_ssize_t n, Py_ssize_t *ppos, PyObject *pool)
+{
+  Py_ssize_t pos = *ppos, end;
+  Py_UNICODE ch = s[pos];
+  PyObject *group, *val;
+
+  if (ch == '"') {
+    return read_string(s, n, ppos, pool);
+  } else if (ch == ':') {
+    /* :(?:[^\W_]|-)* */
+    end = pos + 1;
+    while (end < n && (Py_UNICODE_ISALNUM(s[end]) || s[end] == '-')) end++;
+    if (end == n && end - pos <= 2) return syntax_error("EOF while reading keyword");
+    group = slice(s, pos, end);
+    if (!group) return NULL;
+    val = PyObject_CallFunctionObjArgs(keyword_cls, group, NULL);
+    Py_DECREF(group);
+    *ppos = end;
+    return val;
+  } else if (Py_UNICODE_ISDIGIT(ch) || ch == '-') {
+    /* (?:\d|-)+ */
+    end = pos;
+    while (end < n && (Py_UNICODE_ISDECIMAL(s[end]) || s[end] == '-')) end++;
+    if (end == pos) {
+      /* a digit that isn't decimal (e.g. a superscript), which the regex in sexp.py doesn't match either */
+      group = slice(s, pos, pos + 1);
+      if (!group) return NULL;
+      malformed_int(group);
+      Py_DECREF(group);
+      return NULL;
+    }
+    group = slice(s, pos, end);
+    if (!group) return NULL;
+    val = PyObject_CallFunctionObjArgs((PyObject *) &PyInt_Type, group, NULL);
+    if (!val && PyErr_ExceptionMatches(PyExc_ValueError)) {
+      PyErr_Clear();
+      malformed_int(group);
+    }
+    Py_DECREF(group);
+    *ppos = end;
+    return val;
+  } else if (Py_UNICODE_ISALPHA(ch)) {
+    /* (?:[^\W_]|[-:])+ */
+    end = pos;
+    while (end < n && (Py_UNICODE_ISALNUM(s[end]) || s[end] == '-' || s[end] == ':')) end++;
+    *ppos = end;
+    if (end - pos == 1 && ch == 't') { Py_RETURN_TRUE; }
+    if (end - pos == 3 && ch == 'n' && s[pos + 1] == 'i' && s[pos + 2] == 'l') { Py_RETURN_FALSE; }
+    group = slice(s, pos, end);
+    if (!group) return NULL;
+    val = PyObject_CallFunctionObjArgs(symbol_cls, group, NULL);
+    Py_DECREF(group);
+    return val;
+  } else if (ch == '\'') {
+    /* a quoted atom extends up to the next whitespace */
+    end = pos + 1;
+    while (end < n && !Py_UNICODE_ISSPACE(s[end])) end++;
+    if (end >= n) return syntax_error("EOF while reading atom");
+    *ppos = end + 1;
+    return slice(s, pos + 1, end);
+  } else if (Py_UNICODE_ISSPACE(ch)) {
+    return syntax_error("unexpected whitespace while reading form");
+  } else {
+    group = slice(s, pos, pos + 1);
+    if (!group) return NULL;
+    syntax_error_with("unexpected character in read_form: ", group);
+    Py_DECREF(group);
+    return NULL;
+  }
+}
+
+static PyObject *
+read_form(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+  static char *kwlist[] = {"s", "pos", "pool", "relaxed", NULL};
+  PyObject *str, *pos_obj = NULL, *pool = Py_None, *relaxed = Py_False;
+  PyObject *stack, *val, *result;
+  const Py_UNICODE *s;
+  Py_ssize_t n, pos, depth;
+  int is_relaxed;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OOO:read_form", kwlist, &str, &pos_obj, &pool, &relaxed))
+    return NULL;
+  is_relaxed = PyObject_IsTrue(relaxed);
+  if (is_relaxed < 0) return NULL;
+  pos = 0;
+  if (pos_obj && PyInt_Check(pos_obj)) pos = PyInt_AS_LONG(pos_obj);
+  /* anything out of the ordinary is read by sexp.py */
+  if (!PyUnicode_CheckExact(str) || is_relaxed || (pos_obj && !PyInt_Check(pos_obj)) || pos < 0)
+    return PyObject_Call(py_read_form, args, kwargs);
+
+  s = PyUnicode_AS_UNICODE(str);
+  n = PyUnicode_GET_SIZE(str);
+  stack = PyList_New(0);
+  if (!stack) return NULL;
+  while (1) {
+    if (pos >= n) { Py_DECREF(stack); return syntax_error("unexpected EOF while reading form"); }
+    if (s[pos] == '(') {
+      val = PyList_New(0);
+      if (!val || PyList_Append(stack, val) < 0) { Py_XDECREF(val); Py_DECREF(stack); return NULL; }
+      Py_DECREF(val);
+      pos++;
+    } else {
+      val = read_atom(s, n, &pos, pool);
+      if (!val) { Py_DECREF(stack); return NULL; }
+      depth = PyList_GET_SIZE(stack);
+      if (!depth) {
+        Py_DECREF(stack);
+        result = Py_BuildValue("(Nn)", val, pos);
+        return result;
+      }
+      if (PyList_Append(PyList_GET_ITEM(stack, depth - 1), val) < 0) { Py_DECREF(val); Py_DECREF(stack); return NULL; }
+      Py_DECREF(val);
+    }
+    /* we're inside a list: skip whitespace and close all lists that end here */
+    while (1) {
+      while (pos < n && Py_UNICODE_ISSPACE(s[pos])) pos++;
+      if (pos >= n) { Py_DECREF(stack); return syntax_error("EOF while reading list"); }
+      if (s[pos] != ')') break;
+      pos++;
+      depth = PyList_GET_SIZE(stack);
+      val = PyList_GET_ITEM(stack, depth - 1);
+      Py_INCREF(val);
+      if (PyList_SetSlice(stack, depth - 1, depth, NULL) < 0) { Py_DECREF(val); Py_DECREF(stack); return NULL; }
+      if (depth == 1) {
+        Py_DECREF(stack);
+        return Py_BuildValue("(Nn)", val, pos);
+      }
+      if (PyList_Append(PyList_GET_ITEM(stack, depth - 2), val) < 0) { Py_DECREF(val); Py_DECREF(stack); return NULL; }
+      Py_DECREF(val);
+    }
+  }
+}
+
+/* ============================== WRITER ============================== */
+
+typedef struct {
+  char *data;
+  Py_ssize_t size;
+  Py_ssize_t capacity;
+} Buffer;
+
+static int
+buffer_reserve(Buffer *buf, Py_ssize_t extra)
+{
+  char *data;
+  Py_ssize_t capacity = buf->capacity;
+  if (buf->size + extra <= capacity) return 0;
+  while (buf->size + extra > capacity) capacity = capacity * 2 + 64;
+  data = (char *) PyMem_Realloc(buf->data, capacity);
+  if (!data) { PyErr_NoMemory(); return -1; }
+  buf->data = data;
+  buf->capacity = capacity;
+  return 0;
+}
+
+static int
+buffer_append(Buffer *buf, const char *data, Py_ssize_t size)
+{
+  if (buffer_reserve(buf, size) < 0) return -1;
+  memcpy(buf->data + buf->size, data, size);
+  buf->size += size;
+  return 0;
+}
+
+/* appends the utf-8 representation of exp and returns its length in characters, or -1 on error */
+static Py_ssize_t
+write_form(PyObject *exp, Buffer *buf)
+{
+  PyTypeObject *type = Py_TYPE(exp);
+  PyObject *val, *encoded;
+  Py_ssize_t chars, i, n, size, escapes;
+  const char *bytes;
+
+  if (PyList_Check(exp)) {
+    if (Py_EnterRecursiveCall(" while writing a sexp")) return -1;
+    n = PyList_GET_SIZE(exp);
+    chars = n ? n + 1 : 2;
+    if (buffer_append(buf, "(", 1) < 0) goto list_error;
+    for (i = 0; i < PyList_GET_SIZE(exp); i++) {
+      Py_ssize_t elem_chars;
+      if (i && buffer_append(buf, " ", 1) < 0) goto list_error;
+      elem_chars = write_form(PyList_GET_ITEM(exp, i), buf);
+      if (elem_chars < 0) goto list_error;
+      chars += elem_chars;
+    }
+    if (buffer_append(buf, ")", 1) < 0) goto list_error;
+    Py_LeaveRecursiveCall();
+    return chars;
+  list_error:
+    Py_LeaveRecursiveCall();
+    return -1;
+  } else if (type == &PyBool_Type) {
+    if (exp == Py_True) return buffer_append(buf, "t", 1) < 0 ? -1 : 1;
+    return buffer_append(buf, "nil", 3) < 0 ? -1 : 3;
+  } else if ((PyObject *) type == symbol_cls || (PyObject *) type == keyword_cls) {
+    val = PyObject_GetAttrString(exp, "val");
+    if (!val) return -1;
+    if (PyUnicode_Check(val)) {
+      chars = PyUnicode_GET_SIZE(val);
+      encoded = PyUnicode_AsUTF8String(val);
+      Py_DECREF(val);
+      if (!encoded) return -1;
+    } else if (PyString_Check(val)) {
+      chars = PyString_GET_SIZE(val);
+      encoded = val;
+    } else {
+      Py_DECREF(val);
+      PyErr_SetString(PyExc_TypeError, "an atom must be named by a string");
+      return -1;
+    }
+    i = buffer_append(buf, PyString_AS_STRING(encoded), PyString_GET_SIZE(encoded));
+    Py_DECREF(encoded);
+    return i < 0 ? -1 : chars;
+  } else if (PyString_Check(exp) || PyUnicode_Check(exp)) {
+    if (PyString_Check(exp)) {
+      val = PyUnicode_DecodeUTF8(PyString_AS_STRING(exp), PyString_GET_SIZE(exp), "strict");
+      if (!val) return -1;
+    } else {
+      val = exp;
+      Py_INCREF(val);
+    }
+    chars = PyUnicode_GET_SIZE(val);
+    encoded = PyUnicode_AsUTF8String(val);
+    Py_DECREF(val);
+    if (!encoded) return -1;
+    /* backslashes and quotes are ascii, so they can be escaped in the encoded form */
+    bytes = PyString_AS_STRING(encoded);
+    size = PyString_GET_SIZE(encoded);
+    escapes = 0;
+    for (i = 0; i < size; i++)
+      if (bytes[i] == '\\' || bytes[i] == '"') escapes++;
+    if (buffer_reserve(buf, size + escapes + 2) < 0) { Py_DECREF(encoded); return -1; }
+    buf->data[buf->size++] = '"';
+    for (i = 0; i < size; i++) {
+      if (bytes[i] == '\\' || bytes[i] == '"') buf->data[buf->size++] = '\\';
+      buf->data[buf->size++] = bytes[i];
+    }
+    buf->data[buf->size++] = '"';
+    Py_DECREF(encoded);
+    return chars + escapes + 2;
+  } else {
+    val = PyObject_Str(exp);
+    if (!val) return -1;
+    chars = PyString_GET_SIZE(val);
+    i = buffer_append(buf, PyString_AS_STRING(val), chars);
+    Py_DECREF(val);
+    return i < 0 ? -1 : chars;
+  }
+}
+
+static PyObject *
+to_frame(PyObject *self, PyObject *exp)
+{
+  Buffer buf = {NULL, 0, 0};
+  Py_ssize_t chars;
+  char header[32];
+  PyObject *result;
+
+  if (buffer_append(&buf, "000000", 6) < 0) return NULL;
+  chars = write_form(exp, &buf);
+  if (chars < 0) { PyMem_Free(buf.data); return NULL; }
+  PyOS_snprintf(header, sizeof(header), "%06lx", (unsigned long) chars);
+  if (strlen(header) == 6) {
+    memcpy(buf.data, header, 6);
+    result = PyString_FromStringAndSize(buf.data, buf.size);
+  } else {
+    /* doesn't fit into the header, which is what sexp.py does as well */
+    result = PyString_FromStringAndSize(NULL, buf.size - 6 + strlen(header));
+    if (result) {
+      memcpy(PyString_AS_STRING(result), header, strlen(header));
+      memcpy(PyString_AS_STRING(result) + strlen(header), buf.data + 6, buf.size - 6);
+    }
+  }
+  PyMem_Free(buf.data);
+  return result;
+}
+
+/* ============================== MODULE ============================== */
+
+static PyMethodDef codec_methods[] = {
+  {"read_form", (PyCFunction) read_form, METH_VARARGS | METH_KEYWORDS,
+   "read_form(s, pos = 0, pool = None, relaxed = False) -> (form, position right after the form)"},
+  {"to_frame", (PyCFunction) to_frame, METH_O,
+   "to_frame(exp) -> a six-digit hex length header followed by the utf-8 encoded form"},
+  {NULL, NULL, 0, NULL}
+};
+
+static PyObject *
+codec(PyObject *self, PyObject *args)
+{
+  PyObject *keyword, *symbol, *fallback, *reader, *writer;
+  if (!PyArg_ParseTuple(args, "OOO:codec", &keyword, &symbol, &fallback)) return NULL;
+  Py_XDECREF(keyword_cls);
+  Py_XDECREF(symbol_cls);
+  Py_XDECREF(py_read_form);
+  Py_INCREF(keyword);
+  Py_INCREF(symbol);
+  Py_INCREF(fallback);
+  keyword_cls = keyword;
+  symbol_cls = symbol;
+  py_read_form = fallback;
+  reader = PyCFunction_New(&codec_methods[0], NULL);
+  writer = PyCFunction_New(&codec_methods[1], NULL);
+  if (!reader || !writer) { Py_XDECREF(reader); Py_XDECREF(writer); return NULL; }
+  return Py_BuildValue("(NN)", reader, writer);
+}
+
+static PyMethodDef module_methods[] = {
+  {"codec", codec, METH_VARARGS,
+   "codec(Keyword, Symbol, read_form) -> (read_form, to_frame)\n\n"
+   "The given read_form is the pure Python reader, which handles inputs that aren't unicode and relaxed mode."},
+  {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC
+init_sexp_speedups(void)
+{
+  Py_InitModule3("_sexp_speedups", module_methods, "Compiled implementation of read_form and to_frame from sexp.py");
+}
@@ -0,0 +1,104 @@
+# compares the decoders that rpc.py compiles from record schemas with the populate methods they have replaced:
+#
+#   python bench/decoders.py
+#
+# this lives outside of the package root, because sublime loads every .py file there as a plugin
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import sexp
+from rpc import ActiveRecord, Note, Completion, DebugStackFrame, DebugValue
+
+# the records exactly as they were decoded before schemas: sexp_to_key_map followed by populate
+
+class PopulatedNote(ActiveRecord):
+  def populate(self, m):
+    self.message = m[":msg"]
+    self.file_name = m[":file"]
+    self.severity = m[":severity"]
+    self.start = m[":beg"]
+    self.end = m[":end"]
+    self.line = m[":line"]
+    self.col = m[":col"]
+
+class PopulatedCompletion(ActiveRecord):
+  def populate(self, m):
+    self.name = m[":name"]
+    self.signature = m[":type-sig"]
+    self.is_callable = bool(m[":is-callable"]) if ":is-callable" in m else False
+    self.type_id = m[":type-id"]
+    self.to_insert = m[":to-insert"] if ":to-insert" in m else None
+
+class PopulatedDebugStackFrame(ActiveRecord):
+  def populate(self, m):
+    self.index = m[":index"]
+    self.locals = PopulatedDebugStackLocal.parse_list(m[":locals"]) if ":locals" in m else []
+    self.num_args = m[":num-args"]
+    self.class_name = m[":class-name"]
+    self.method_name = m[":method-name"]
+    self.pc_location = PopulatedDebugSourcePosition.parse(m[":pc-location"])
+    self.this_object_id = m[":this-object-id"]
+
+class PopulatedDebugSourcePosition(ActiveRecord):
+  def populate(self, m):
+    self.file_name = m[":file"]
+    self.line = m[":line"]
+
+class PopulatedDebugStackLocal(ActiveRecord):
+  def populate(self, m):
+    self.index = m[":index"]
+    self.name = m[":name"]
+    self.summary = m[":summary"]
+    self.type_name = m[":type-name"]
+
+class PopulatedDebugValue(ActiveRecord):
+  def populate(self, m):
+    self.type = m[":val-type"]
+    self.type_name = m[":type-name"]
+    self.length = m[":length"] if ":length" in m else None
+    self.element_type_name = m[":element-type-name"] if ":element-type-name" in m else None
+    self.summary = m[":summary"] if ":summary" in m else None
+    self.object_id = m[":object-id"] if ":object-id" in m else None
+    self.fields = PopulatedDebugObjectField.parse_list(m[":fields"]) if ":fields" in m else []
+    if str(self.type) == "null" or str(self.type) == "prim" or str(self.type) == "obj" or str(self.type) == "str" or str(self.type) == "arr":
+      pass
+    else:
+      raise Exception("unexpected debug value of type " + str(self.type) + ": " + str(m))
+
+class PopulatedDebugObjectField(ActiveRecord):
+  def populate(self, m):
+    self.index = m[":index"]
+    self.name = m[":name"]
+    self.summary = m[":summary"]
+    self.type_name = m[":type-name"]
+
+def fields(value):
+  if isinstance(value, ActiveRecord): return dict((k, fields(v)) for k, v in value.__dict__.iteritems())
+  if type(value) == list: return [fields(v) for v in value]
+  return value
+
+recorded_payloads = [
+  (Completion, PopulatedCompletion, '(:name "foreach" :type-sig (((("f" "(Int) => U"))) "Unit") :is-callable t :type-id 12 :to-insert nil)'),
+  (Note, PopulatedNote, '(:severity error :msg "type mismatch;\\n found   : Int\\n required: String" :beg 1208 :end 1213 :line 48 :col 17 :file "/home/user/project/src/main/scala/Main.scala")'),
+  (DebugStackFrame, PopulatedDebugStackFrame, '(:index 0 :locals ((:index 0 :name "args" :summary "Array[]" :type-name "java.lang.String[]")) :num-args 1 :class-name "Main$" :method-name "main" :pc-location (:file "/home/user/project/src/main/scala/Main.scala" :line 5) :this-object-id "1")'),
+  (DebugValue, PopulatedDebugValue, '(:val-type obj :type-name "scala.Some" :object-id "7" :summary "Some(1)" :fields ((:index 0 :name "x" :summary "1" :type-name "java.lang.Object")))')]
+
+def best(parse, raw, iterations, repeat):
+  timings = []
+  for r in xrange(repeat):
+    start = time.time()
+    for i in xrange(iterations): parse(raw)
+    timings.append(time.time() - start)
+  return min(timings)
+
+def bench_decoders(iterations = 20000, repeat = 5):
+  for cls, populated, payload in recorded_payloads:
+    raw = sexp.read(payload)
+    # the copies above would drift from the real records unnoticed otherwise
+    assert fields(cls.parse(raw)) == fields(populated.parse(raw)), cls.__name__
+    before = best(populated.parse, raw, iterations, repeat)
+    after = best(cls.parse, raw, iterations, repeat)
+    print("%s: populate %.3f s, compiled decoder %.3f s (x%.1f)" % (cls.__name__, before, after, before / after))
+
+if __name__ == "__main__":
+  bench_decoders()
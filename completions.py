@@ -0,0 +1,209 @@
+import re, threading, traceback
+
+_identifier_re = re.compile(r"^\w*$")
+
+class CompletionCache(object):
+  """Remembers the completions for the word being typed, so that narrowing
+  "fo" -> "foo" -> "foob" is served locally instead of hitting ensime.
+
+  An entry is keyed by (file, start of the word, buffer change count).
+  Edits that only extend or shrink the word move the entry forward to the
+  new change count, whereas any other edit drops it."""
+
+  def __init__(self):
+    self.clear()
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  def clear(self):
+    self.file_name = None
+    self.anchor = None
+    self.prefix = None
+    self.change_count = None
+    self.size = None
+    self.caret = None
+    self.completions = None
+
+  def store(self, file_name, anchor, prefix, change_count, size, caret, completions):
+    self.file_name = file_name
+    self.anchor = anchor
+    self.prefix = prefix
+    self.change_count = change_count
+    self.size = size
+    self.caret = caret
+    self.completions = completions
+
+  def lookup(self, file_name, anchor, prefix, change_count):
+    """Returns cached completions that match the prefix or None if we need to ask ensime."""
+    if (self.completions is not None and self.file_name == file_name and
+        self.anchor == anchor and self.change_count == change_count and
+        prefix.lower().startswith(self.prefix.lower())):
+      self.hits += 1
+      # the request was case-insensitive, so is the filtering
+      lowered = prefix.lower()
+      return filter(lambda c: c.name.lower().startswith(lowered), self.completions)
+    else:
+      self.misses += 1
+      return None
+
+  def on_modified(self, file_name, change_count, size, caret, substr):
+    """Checks whether the edit that has just happened stays within the word
+    we have completions for. substr(begin, end) returns buffer contents."""
+    if self.completions is None or self.change_count == change_count: return
+    inside = (self.file_name == file_name and
+              caret is not None and caret >= self.anchor and
+              # typing or backspacing moves the caret by exactly as much as the buffer has grown
+              size - self.size == caret - self.caret and
+              _identifier_re.match(substr(self.anchor, caret)))
+    if inside:
+      self.change_count = change_count
+      self.size = size
+      self.caret = caret
+    else:
+      self.invalidations += 1
+      self.clear()
+
+  def hit_rate(self):
+    total = self.hits + self.misses
+    return float(self.hits) / total if total else 0.0
+
+  def stats(self):
+    return ("completion cache: " + str(self.hits) + " hits, " + str(self.misses) + " misses (" +
+            str(int(self.hit_rate() * 100)) + "%), " + str(self.invalidations) + " invalidations")
+
+class SendQueue(object):
+  """Runs jobs on a background thread one by one, in the order they've been submitted,
+  so that e.g. a patch_source can't overtake the one that has been sent before it.
+  The thread quits when it's been idle for a while and is restarted on demand."""
+
+  def __init__(self, name, idle_timeout = 30, on_error = None):
+    self.name = name
+    self.idle_timeout = idle_timeout
+    self.on_error = on_error
+    self._jobs = []
+    self._cond = threading.Condition(threading.Lock())
+    self._running = False
+
+  def submit(self, job):
+    self._cond.acquire()
+    try:
+      self._jobs.append(job)
+      if self._running:
+        self._cond.notify()
+      else:
+        self._running = True
+        t = threading.Thread(name = self.name, target = self._run)
+        t.setDaemon(True)
+        t.start()
+    finally:
+      self._cond.release()
+
+  def _run(self):
+    while True:
+      self._cond.acquire()
+      try:
+        if not self._jobs: self._cond.wait(self.idle_timeout)
+        if not self._jobs:
+          self._running = False
+          return
+        job = self._jobs.pop(0)
+      finally:
+        self._cond.release()
+      try:
+        job()
+      except Exception:
+        if self.on_error: self.on_error(traceback.format_exc())
+
+class _Completion(object):
+  def __init__(self, name):
+    self.name = name
+
+def _typing_trace():
+  # a few lines typed from scratch, the way an editor sees them: one keystroke at a time
+  lines = [
+    "val xs = List(1, 2, 3).map(x => x + 1).filter(isEven).foldLeft(0)(sum)",
+    "val buffer = new StringBuilder(); buffer.append(header).append(separator).toString",
+    "sessions.filterNot(isExpired).groupBy(owner).mapValues(collectStatistics)",
+    "Console.println(notes.sortBy(position).headOption.getOrElse(defaultNote))"]
+  return "\n".join(lines) + "\n"
+
+def _vocabulary(text):
+  return sorted(set(re.findall(r"\w+", text)) | set(["foldRight", "flatMap", "filterKeys", "forall",
+                                                     "appendAll", "headOption", "toSeq", "toString"]))
+
+def _simulate(text, cached):
+  """Replays the trace and returns the number of round trips to the server.
+  Like sublime, we query completions after every identifier keystroke."""
+  vocabulary = _vocabulary(text)
+  cache = CompletionCache()
+  buf = ""
+  change_count = 0
+  round_trips = 0
+  for ch in text:
+    buf += ch
+    change_count += 1
+    caret = len(buf)
+    if cached: cache.on_modified("Trace.scala", change_count, len(buf), caret, lambda b, e: buf[b:e])
+    m = re.search(r"\w+$", buf)
+    if not m: continue
+    prefix = m.group(0)
+    anchor = caret - len(prefix)
+    results = cache.lookup("Trace.scala", anchor, prefix, change_count) if cached else None
+    if results is None:
+      round_trips += 1
+      completions = [_Completion(w) for w in vocabulary if w.lower().startswith(prefix.lower())]
+      if cached: cache.store("Trace.scala", anchor, prefix, change_count, len(buf), caret, completions)
+      results = completions
+    expected = [w for w in vocabulary if w.lower().startswith(prefix.lower())]
+    assert [c.name for c in results] == expected, (prefix, [c.name for c in results], expected)
+  return round_trips, cache
+
+def _check_invalidation():
+  cache = CompletionCache()
+  text = "foo.ba"
+  cache.store("A.scala", 4, "ba", 1, len(text), len(text), [_Completion("bar"), _Completion("baz"), _Completion("Bam")])
+  # narrowing the word keeps the entry
+  text = "foo.bar"
+  cache.on_modified("A.scala", 2, len(text), len(text), lambda b, e: text[b:e])
+  assert [c.name for c in cache.lookup("A.scala", 4, "bar", 2)] == ["bar"]
+  assert [c.name for c in cache.lookup("A.scala", 4, "BA", 2)] == ["bar", "baz", "Bam"]
+  # a prefix that's wider than the cached one needs a new request
+  assert cache.lookup("A.scala", 4, "b", 2) is None
+  # an edit elsewhere in the file drops the entry
+  text = "xfoo.bar"
+  cache.on_modified("A.scala", 3, len(text), 7, lambda b, e: text[b:e])
+  assert cache.lookup("A.scala", 4, "bar", 3) is None
+  assert cache.invalidations == 1
+
+def _check_send_queue():
+  import time
+  done = []
+  finished = threading.Event()
+  queue = SendQueue("test", idle_timeout = 0.05)
+  def job(i):
+    # earlier jobs are slower, so without ordering they would finish last
+    time.sleep(0.01 * (5 - i))
+    done.append(i)
+  for i in xrange(5): queue.submit(lambda i = i: job(i))
+  queue.submit(lambda: 1 / 0) # a failing job doesn't stop the queue
+  queue.submit(finished.set)
+  assert finished.wait(5) is not False and finished.isSet()
+  assert done == range(5), done
+  time.sleep(0.2)
+  assert not queue._running
+  queue.submit(finished.clear)
+  time.sleep(0.1)
+  assert not finished.isSet()
+
+if __name__ == "__main__":
+  _check_invalidation()
+  _check_send_queue()
+  text = _typing_trace()
+  baseline, _ = _simulate(text, cached = False)
+  with_cache, cache = _simulate(text, cached = True)
+  print "typing " + str(len(text)) + " characters"
+  print "server round trips without cache: " + str(baseline)
+  print "server round trips with cache: " + str(with_cache)
+  print cache.stats()
+  assert with_cache < baseline
@@ -3,6 +3,8 @@ ENSIME_NOTES_VIEW = "Ensime notes"
 ENSIME_OUTPUT_VIEW = "Ensime output"
 ENSIME_STACK_VIEW = "Ensime stack"
 ENSIME_WATCHES_VIEW = "Ensime watches"
+ENSIME_RPC_STATS_VIEW = "Ensime RPC stats"
+ENSIME_STARTUP_TIMELINE_VIEW = "Ensime startup timeline"
 
 # region names
 ENSIME_ERROR_OUTLINE_REGION = "ensime-error"
@@ -5,8 +5,13 @@ import difflib
 
 
 def diff_view_with_disk(view):
-  old_s = open(view.file_name()).read()
-  new_s = view.substr(Region(0, view.size()))
+  return diff_text_with_disk(view.file_name(), view.substr(Region(0, view.size())))
+
+
+def diff_text_with_disk(file_name, new_s):
+  """Same as diff_view_with_disk, but doesn't touch the view,
+  so it can be used off the UI thread."""
+  old_s = open(file_name).read()
   return diff(old_s, new_s)
 
 
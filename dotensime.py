@@ -16,6 +16,29 @@ def exists(window):
   expected by `load`."""
   return len(locations(window)) != 0
 
+# parsed configs keyed by path, along with the (mtime, size) they were parsed at
+# generated .ensime files can list thousands of jars, and load is called on every recalc
+_parsed = {}
+
+def _copy(form):
+  # callers are free to mutate the config (see EnsimeEnvironment.project_config)
+  # so we hand out copies of the lists and keep the cached original intact
+  return [_copy(x) for x in form] if type(form) == list else form
+
+def read(f):
+  """Read and parse the .ensime file at the given path.
+  The result of parsing is cached until the file's mtime or size changes."""
+  st = os.stat(f)
+  stamp = (st.st_mtime, st.st_size)
+  cached = _parsed.get(f)
+  if cached and cached[0] == stamp:
+    return _copy(cached[1])
+  with open(f) as open_file:
+    src = open_file.read()
+  conf = sexp.read_relaxed(src)
+  _parsed[f] = (stamp, conf)
+  return _copy(conf)
+
 def load(window):
   """Intelligently guess the appropriate .ensime file location for the
   given window. Load the .ensime and parse as s-expression.
@@ -23,11 +46,8 @@ def load(window):
   """
   for f in locations(window):
     root = encode_path(os.path.dirname(f))
-    src = "()"
-    with open(f) as open_file:
-      src = open_file.read()
     try:
-      conf = sexp.read_relaxed(src)
+      conf = read(f)
       m = sexp.sexp_to_key_map(conf)
       if m.get(":root-dir"):
         root = m[":root-dir"]
@@ -2,12 +2,12 @@ import sublime
 from sublime import *
 from sublime_plugin import *
 import os, threading, thread, socket, getpass, signal, glob
-import subprocess, tempfile, datetime, time, json, zipfile
-import functools, inspect, traceback, random, re, sys
+import subprocess, tempfile, datetime, time, json
+import functools, inspect, traceback, random, re, sys, atexit
 from functools import partial as bind
 from string import strip
 from types import *
-import env, diff, dotensime, dotsession, rpc
+import env, diff, dotensime, dotsession, rpc, transport, handshake, serverjar
 import sexp
 from sexp import key, sym
 from constants import *
@@ -43,6 +43,13 @@ class EnsimeCommon(object):
   def _recalc_session_id(self):
     self.session_id = self._env.session_id if self._env else None
 
+  def rebind(self, w):
+    """Moves an object that outlives its window (e.g. a client shared by several windows) over to another window."""
+    self.owner = w
+    self.w = w
+    self._env = env.for_window(w)
+    self._recalc_session_id()
+
   @property
   def rpc(self):
     return self.env.rpc
@@ -358,15 +365,31 @@ class ClientListener:
     pass
 
 class ClientSocket(EnsimeCommon):
-  def __init__(self, owner, port, timeout, handlers):
+  max_outbox_size = 2**20
+
+  def __init__(self, owner, transport, timeout, handlers):
     super(ClientSocket, self).__init__(owner)
-    self.port = port
+    self.transport = transport
     self.timeout = timeout
     self.connected = False
     self.handlers = handlers
     self._lock = threading.RLock()
     self._connect_lock = threading.RLock()
     self._receiver = None
+    self.reconnecting = False
+    # strings are pooled per connection, so that repeated file names and type names share memory
+    self._reader = sexp.StreamReader(sexp.StringPool())
+    self._header = ""
+    self._remaining = 0
+    # size, parse time and arrival time of the frame that's being dispatched
+    self._frame_size = 0
+    self._parse_time = 0
+    self.last_frame = None
+    # outgoing messages are queued and written by a dedicated thread, so that callers never block on the socket
+    self._outbox = []
+    self._outbox_size = 0
+    self._outbox_cond = threading.Condition(threading.Lock())
+    self._writer = None
     self.socket = None
 
   def notify_async_data(self, data):
@@ -375,73 +398,155 @@ class ClientSocket(EnsimeCommon):
         handler.on_client_async_data(data)
 
   def receive_loop(self):
+    # the socket is read into a reusable buffer, and the reader gets zero-copy slices of it
+    # one recv might bring several frames (e.g. when the server pipelines replies) or just a part of a header
+    # therefore we track the frame we're in between the reads rather than assume any alignment
+    buf = bytearray(2**16)
     while self.connected:
       try:
-        msglen = self.socket.recv(6)
-        if msglen:
-          msglen = int(msglen, 16)
-          self.log_client("RECV: incoming message of " + str(msglen) + " bytes")
-
-          buf = ""
-          while len(buf) < msglen:
-            chunk = self.socket.recv(msglen - len(buf))
-            if chunk:
-              self.log_client("RECV: received a chunk of " + str(len(chunk)) + " bytes")
-              buf += chunk
-            else:
-              raise Exception("fatal error: recv returned None")
-          self.log_client("RECV: " + buf)
-
-          try:
-            s = buf.decode('utf-8')
-            form = sexp.read(s)
-            self.notify_async_data(form)
-          except:
-            self.log_client("failed to parse incoming message")
-            raise
+        received = self.socket.recv_into(buf)
+        if received:
+          self.log_client("RECV: received a chunk of " + str(received) + " bytes")
+          self._receive_frames(buf, received)
         else:
           raise Exception("fatal error: recv returned None")
       except Exception:
         self.log_client("*****    ERROR     *****")
         self.log_client(traceback.format_exc())
-        self.connected = False
-        self.status_message("Ensime server has disconnected")
+        self._outbox_cond.acquire()
+        try:
+          self.connected = False
+          # the writer might be waiting for something to send, and now it should quit
+          self._outbox_cond.notifyAll()
+        finally:
+          self._outbox_cond.release()
         # todo. do we need to check session_ids somewhere else as well?
         if self.env.session_id == self.session_id:
-          self.env.controller.shutdown()
+          # the controller reads settings and talks to windows, which is only safe on the UI thread
+          sublime.set_timeout(self.env.controller.on_client_disconnected, 0)
+
+  def _receive_frames(self, buf, received):
+    pos = 0
+    while pos < received:
+      if self._header is not None:
+        # header is 6 hex digits, which can arrive split across several reads
+        size = min(6 - len(self._header), received - pos)
+        self._header += str(buffer(buf, pos, size))
+        pos += size
+        if len(self._header) < 6: break
+        self._remaining = int(self._header, 16)
+        self._header = None
+        self._frame_size = self._remaining
+        self._parse_time = 0
+        self.log_client("RECV: incoming message of " + str(self._remaining) + " bytes")
+      # body is parsed as it arrives, so we never hold the entire message
+      size = min(self._remaining, received - pos)
+      self._remaining -= size
+      try:
+        start = time.time()
+        forms = self._reader.feed(buffer(buf, pos, size), final = self._remaining == 0)
+        self._parse_time += time.time() - start
+      except:
+        self.log_client("failed to parse incoming message")
+        raise
+      pos += size
+      if self._remaining == 0: self._header = ""
+      for form in forms:
+        self.last_frame = (self._frame_size, self._parse_time, time.time())
+        self.notify_async_data(form)
 
   def start_receiving(self):
-    t = threading.Thread(name = "ensime-client-" + str(self.w.id()) + "-" + str(self.port), target = self.receive_loop)
+    t = threading.Thread(name = "ensime-client-" + str(self.w.id()) + "-" + str(self.transport), target = self.receive_loop)
     t.setDaemon(True)
     t.start()
     self._receiver = t
 
-  def connect(self):
+  def start_sending(self):
+    t = threading.Thread(name = "ensime-writer-" + str(self.w.id()) + "-" + str(self.transport), target = bind(self.send_loop, self.socket))
+    t.setDaemon(True)
+    t.start()
+    self._writer = t
+
+  def send_loop(self, s):
+    # a burst of small requests (e.g. typecheck_file + patch_source + completions) is coalesced into a single write
+    # the writer is bound to a particular socket, so that it quits after a reconnect rather than compete with its successor
+    while True:
+      self._outbox_cond.acquire()
+      try:
+        while not self._outbox and self.connected and self.socket is s:
+          self._outbox_cond.wait()
+        if not self.connected or self.socket is not s:
+          return
+        batch = self._outbox
+        self._outbox = []
+        self._outbox_size = 0
+        self._outbox_cond.notifyAll()
+      finally:
+        self._outbox_cond.release()
+      try:
+        data = "".join(map(lambda entry: entry[0], batch))
+        if len(batch) > 1:
+          self.log_client("SEND: coalesced " + str(len(batch)) + " messages into " + str(len(data)) + " bytes")
+        s.sendall(data)
+        sent_at = time.time()
+        for _, queued_at, on_sent in batch:
+          if on_sent: on_sent(queued_at, sent_at, s)
+      except Exception:
+        self.log_client("*****    ERROR     *****")
+        self.log_client(traceback.format_exc())
+        # we don't know how much of the batch has made it, so it shares the fate of the requests written before it
+        for _, queued_at, on_sent in batch:
+          if on_sent: on_sent(queued_at, None, s)
+        # wakes up the receiver, which takes care of the disconnect
+        try: s.shutdown(socket.SHUT_RDWR)
+        except: pass
+        return
+
+  def connect(self, give_up = True):
     self._connect_lock.acquire()
     try:
-      s = socket.socket()
-      s.settimeout(self.timeout)
-      s.connect(("127.0.0.1", self.port))
-      s.settimeout(None)
+      s = self.transport.connect(self.timeout)
       self.socket = s
+      self._header = ""
+      self._remaining = 0
+      self._reader.reset()
       self.connected = True
       self.start_receiving()
+      self.start_sending()
       return s
-    except socket.error as e:
+    except (socket.error, EnvironmentError) as e:
       self.connected = False
-      self.log_client("Cannot connect to Ensime server:  " + str(e.args))
-      self.status_message("Cannot connect to Ensime server")
-      self.env.controller.shutdown()
+      self.log_client("Cannot connect to Ensime server at " + str(self.transport) + ":  " + str(e.args))
+      if give_up:
+        self.status_message("Cannot connect to Ensime server")
+        self.env.controller.shutdown()
     finally:
       self._connect_lock.release()
 
-  def send(self, request):
-    try:
+  def send(self, request, on_sent = None, sheddable = False):
+    """Queues a request for the writer. Never blocks, because callers are usually on the UI thread.
+    Returns False if the request has been dropped, i.e. there's no connection, or the outbox is full and the request is sheddable."""
+    # while we're reconnecting, requests pile up in the outbox and get sent once the connection is back
+    if not self.connected and not self.reconnecting:
+      self.connect()
       if not self.connected:
-        self.connect()
-      self.socket.send(request)
-    except:
-      self.connected = False
+        return False
+    self._outbox_cond.acquire()
+    try:
+      # when the kernel buffer is full, the writer stalls and the outbox grows
+      # past a certain size we shed queries rather than queue up indefinitely or make the caller wait
+      # requests that change the state of the server are queued nevertheless, otherwise it would get out of sync with the editor
+      if self._outbox_size + len(request) > self.max_outbox_size and self._outbox:
+        if sheddable:
+          self.log_client("SEND: outbox is full (" + str(self._outbox_size) + " bytes), dropping a query of " + str(len(request)) + " bytes")
+          return False
+        self.log_client("SEND: outbox is full (" + str(self._outbox_size) + " bytes), queueing a request of " + str(len(request)) + " bytes anyway")
+      self._outbox.append((request, time.time(), on_sent))
+      self._outbox_size += len(request)
+      self._outbox_cond.notifyAll()
+      return True
+    finally:
+      self._outbox_cond.release()
 
   def close(self):
     self._connect_lock.acquire()
@@ -450,12 +555,20 @@ class ClientSocket(EnsimeCommon):
         self.socket.close()
     finally:
       self.connected = False
+      self.reconnecting = False
+      self._outbox_cond.acquire()
+      try:
+        self._outbox = []
+        self._outbox_size = 0
+        self._outbox_cond.notifyAll()
+      finally:
+        self._outbox_cond.release()
       self._connect_lock.release()
 
 class Client(ClientListener, EnsimeCommon):
-  def __init__(self, owner, port_file, timeout):
+  def __init__(self, owner, transport, timeout):
     super(Client, self).__init__(owner)
-    with open(port_file) as f: self.port = int(f.read())
+    self.transport = transport
     self.timeout = timeout
     self.init_counters()
     #methods in the client
@@ -463,49 +576,216 @@ class Client(ClientListener, EnsimeCommon):
     self.log_client("reflectively found " + str(len(methods)) + " message handlers: " + str(methods))
     #handlers - same names as the method names with small modifs
     self.handlers = dict((":" + m[0][len("message_"):].replace("_", "-"), (m[1], None, None)) for m in methods)
+    #requests that are waiting for a reply
+    self.requests = rpc.RequestTable()
+    #background requests that are waiting for their turn
+    self.scheduler = rpc.BackgroundScheduler(self.next_message_id, self.env.settings.get("max_background_requests_in_flight") or 2)
   
   def startup(self):
     self.log_client("Starting Ensime client (plugin version is " + (self.env.settings.get("plugin_version") or "unknown") + ")")
-    self.log_client("Launching Ensime client socket at port " + str(self.port))
-    self.socket = ClientSocket(self.owner, self.port, self.timeout, [self, self.env.controller])
+    self.log_client("Using the " + ("compiled" if sexp.accelerated else "pure Python") + " sexp codec" +
+                    (": " + sexp.fallback_reason if sexp.fallback_reason else ""))
+    self.log_client("Launching Ensime client socket at " + str(self.transport))
+    self.socket = ClientSocket(self.owner, self.transport, self.timeout, [self, self.env.controller])
     return self.socket.connect()
 
   def shutdown(self):
     if self.socket.connected: self.rpc.shutdown_server()
     self.socket.close()
     self.socket = None
-
-  def async_req(self, to_send, on_complete = None, call_back_into_ui_thread = None):
+    # nobody is going to reply, so sync callers shouldn't wait until their timeouts
+    for req in self.requests.clear():
+      if req.handler is not None and not callable(req.handler): req.handler.set()
+    self.scheduler.clear()
+
+  def _register(self, msg_id, to_send, handler, call_back_into_ui_thread, timeout, frame):
+    method = str(to_send[0])
+    self.env.rpc_metrics.record(method, request_bytes = len(frame))
+    expired = self.requests.add(msg_id, method, handler, call_back_into_ui_thread, timeout, frame)
+    for req in expired:
+      self.log_client("request #" + str(req.msg_id) + " (" + req.method + ") has timed out after " +
+                      str(req.deadline - req.time) + " seconds, reaping it")
+      self.scheduler.done(req.msg_id)
+
+  def async_req(self, to_send, on_complete = None, call_back_into_ui_thread = None, timeout = None, background_key = None, msg_id = None):
     if on_complete is not None and call_back_into_ui_thread is None:
       raise Exception("must specify a threading policy when providing a non-empty callback")
     if not self.socket:
       raise Exception("socket is either not yet initialized or is already destroyed")
 
-    msg_id = self.next_message_id()
-    self.handlers[msg_id] = (on_complete, call_back_into_ui_thread, time.time())
-    msg_str = sexp.to_string([key(":swank-rpc"), to_send, msg_id])
-    msg_str = "%06x" % len(msg_str) + msg_str
+    if background_key:
+      # the scheduler sends the request when it's its turn, so there's no message id yet
+      send = lambda msg_id: self.async_req(to_send, on_complete, call_back_into_ui_thread, timeout, msg_id = msg_id)
+      self.scheduler.submit(background_key, send)
+      self.log_client("SCHEDULE BACKGROUND REQ: " + str(background_key) + " (" + self.scheduler.stats() + ")")
+      return None
+
+    msg_id = msg_id or self.next_message_id()
+    msg_str = sexp.to_frame([key(":swank-rpc"), to_send, msg_id])
+    self._register(msg_id, to_send, on_complete, call_back_into_ui_thread,
+                   timeout or self.env.settings.get("timeout_async_requests") or 600, msg_str)
 
     self.feedback(msg_str)
     self.log_client("SEND ASYNC REQ: " + msg_str)
-    self.socket.send(encode_if_unicode(msg_str))
+    if not self.socket.send(msg_str, bind(self._on_sent, msg_id), str(to_send[0]) in rpc.QUERY_METHODS):
+      self._dropped(msg_id)
+    return msg_id
+
+  def _dropped(self, msg_id):
+    # the request has never made it to the outbox, so nobody's going to reply
+    req = self.requests.cancel(msg_id)
+    self.scheduler.done(msg_id)
+    if req:
+      self.log_client("request #" + str(msg_id) + " (" + req.method + ") couldn't be sent")
+      self.status_message("Ensime server is busy or unreachable, " + req.method + " has been skipped")
+      if req.handler is not None and not callable(req.handler): req.handler.set()
+
+  def _on_sent(self, msg_id, queued_at, sent_at, connection):
+    req = self.requests.get(msg_id)
+    if req:
+      req.connection = connection
+      if sent_at:
+        req.sent = sent_at
+        self.env.rpc_metrics.record(req.method, queue_wait = sent_at - queued_at)
+
+  def _frame_stats(self):
+    frame = self.socket.last_frame if self.socket else None
+    return frame or (None, None, time.time())
+
+  def reconnect(self, on_failure):
+    """Must be called on the UI thread, because settings can only be read there.
+    on_failure is called back into the UI thread once all attempts have failed."""
+    self.socket.reconnecting = True
+    attempts = self.env.settings.get("reconnect_attempts") or 0
+    delay = self.env.settings.get("reconnect_initial_delay") or 0.5
+    max_delay = self.env.settings.get("reconnect_max_delay") or 8
+    loop = bind(self._reconnect_loop, on_failure, attempts, delay, max_delay)
+    t = threading.Thread(name = "ensime-reconnect-" + str(self.w.id()) + "-" + str(self.transport), target = loop)
+    t.setDaemon(True)
+    t.start()
+
+  def _reconnect_loop(self, on_failure, attempts, delay, max_delay):
+    client_socket = self.socket
+    lost = client_socket.socket
+    for attempt in xrange(attempts):
+      time.sleep(delay)
+      # the client might have been shut down in the meanwhile
+      if self.socket is not client_socket or not client_socket.reconnecting: return
+      self.log_client("Reconnecting to Ensime server at " + str(self.transport) + " (attempt " + str(attempt + 1) + " of " + str(attempts) + ")")
+      if client_socket.connect(give_up = False):
+        client_socket.reconnecting = False
+        self.status_message("Reconnected to Ensime server")
+        self.replay(lost)
+        return
+      delay = min(delay * 2, max_delay)
+    if self.socket is client_socket and client_socket.reconnecting:
+      client_socket.reconnecting = False
+      sublime.set_timeout(on_failure, 0)
+
+  def replay(self, lost):
+    # we don't know which of the requests written to the lost connection have made it to the server
+    # idempotent ones are sent again under the same ids, and the others are given up on
+    # requests that have been made while we were reconnecting are still in the outbox, so they are left alone
+    for req in self.requests.pending():
+      if req.connection is not lost: continue
+      if req.method in rpc.IDEMPOTENT_METHODS and req.frame:
+        self.log_client("replaying request #" + str(req.msg_id) + " (" + req.method + ")")
+        if not self.socket.send(req.frame, bind(self._on_sent, req.msg_id), req.method in rpc.QUERY_METHODS): self._dropped(req.msg_id)
+      else:
+        self.log_client("request #" + str(req.msg_id) + " (" + req.method + ") has been lost with the connection")
+        self.cancel(req.msg_id)
+        # sync callers would otherwise wait until their timeouts
+        if req.handler is not None and not callable(req.handler): req.handler.set()
+
+  def batch_req(self, to_sends, on_complete = None, timeout = 0):
+    """Sends all requests in a single write without waiting for replies in between.
+    Without a callback, blocks until all replies arrive (or the timeout expires) and returns the payloads.
+    With a callback, calls it back into the UI thread with the payloads.
+    Requests that fail or time out have None in place of their payloads."""
+    if not self.socket:
+      raise Exception("socket is either not yet initialized or is already destroyed")
+    max_wait = timeout or self.timeout
+    payloads = [None] * len(to_sends)
+    msg_ids = []
+    state = {"left": len(to_sends), "done": False}
+    lock = threading.Lock()
+    event = threading.Event()
+    def finish():
+      lock.acquire()
+      try:
+        if state["done"]: return
+        state["done"] = True
+      finally:
+        lock.release()
+      for msg_id in msg_ids: self.requests.cancel(msg_id)
+      if on_complete: sublime.set_timeout(bind(on_complete, payloads), 0)
+      event.set()
+    def resolve(i, payload):
+      lock.acquire()
+      try:
+        payloads[i] = payload
+        state["left"] -= 1
+        left = state["left"]
+      finally:
+        lock.release()
+      if left == 0: finish()
+
+    frames = []
+    for i, to_send in enumerate(to_sends):
+      msg_id = self.next_message_id()
+      msg_str = sexp.to_frame([key(":swank-rpc"), to_send, msg_id])
+      # replies are collected on the receiver thread, and the batch calls back into the ui thread at once
+      self._register(msg_id, to_send, bind(resolve, i), False, max_wait, msg_str)
+      msg_ids.append(msg_id)
+      frames.append(msg_str)
+    if not frames:
+      finish()
+      return payloads if not on_complete else None
+
+    self.log_client("SEND BATCH REQ: " + str(len(frames)) + " requests #" + str(msg_ids[0]) + "..#" + str(msg_ids[-1]))
+    def on_sent(queued_at, sent_at, connection):
+      for msg_id in msg_ids: self._on_sent(msg_id, queued_at, sent_at, connection)
+    sheddable = not filter(lambda to_send: not str(to_send[0]) in rpc.QUERY_METHODS, to_sends)
+    if not self.socket.send("".join(frames), on_sent, sheddable):
+      self.log_client("batch of " + str(len(frames)) + " requests couldn't be sent")
+      self.status_message("Ensime server is busy or unreachable, a batch of " + str(len(frames)) + " requests has been skipped")
+      finish()
+      return payloads if not on_complete else None
+
+    if on_complete:
+      sublime.set_timeout(finish, int(max_wait * 1000))
+    else:
+      event.wait(max_wait)
+      if state["left"]:
+        self.log_client("batch of " + str(len(frames)) + " requests has timed out with " + str(state["left"]) + " replies missing")
+      finish()
+      return payloads
+
+  def cancel(self, msg_id):
+    # ensime can't abort a request, but we can make sure that its response is ignored
+    if self.requests.cancel(msg_id):
+      self.log_client("request #" + str(msg_id) + " has been cancelled")
+    self.scheduler.done(msg_id)
 
   def sync_req(self, to_send, timeout=0):
     msg_id = self.next_message_id()
     event = threading.Event()
-    self.handlers[msg_id] = (event, None, time.time())
-    msg_str = sexp.to_string([key(":swank-rpc"), to_send, msg_id])
-    msg_str = "%06x" % len(msg_str) + msg_str
+    max_wait = timeout or self.timeout
+    msg_str = sexp.to_frame([key(":swank-rpc"), to_send, msg_id])
+    self._register(msg_id, to_send, event, None, max_wait, msg_str)
 
     self.feedback(msg_str)
     self.log_client("SEND SYNC REQ: " + msg_str)
-    self.socket.send(msg_str)
+    if not self.socket.send(msg_str, bind(self._on_sent, msg_id), str(to_send[0]) in rpc.QUERY_METHODS):
+      self._dropped(msg_id)
+      return None
 
-    max_wait = timeout or self.timeout
     event.wait(max_wait)
     if hasattr(event, "payload"):
       return event.payload
     else:
+      # a reply that arrives from now on has nobody to go to
+      self.requests.cancel(msg_id)
       self.log_client("sync_req #" + str(msg_id) +
                       " has timed out (didn't get a response after " +
                       str(max_wait) + " seconds)")
@@ -525,6 +805,9 @@ class Client(ClientListener, EnsimeCommon):
     # (:typecheck-result (:lang :scala :is-full t :notes nil))
     msg_type = str(data[0]) 
     self.log_client("Message type is : "+ str(msg_type))
+    if msg_type != ":return":
+      size, parse_time, _ = self._frame_stats()
+      self.env.rpc_metrics.record(msg_type, response_bytes = size, parse_time = parse_time)
     handler = self.handlers.get(msg_type)
 
     if handler:
@@ -540,10 +823,17 @@ class Client(ClientListener, EnsimeCommon):
 
   def message_return(self, msg_id, payload):
     self.log_client("Return message " + str(msg_id))
-    handler, call_back_into_ui_thread, req_time = self.handlers.get(msg_id)
-    if handler: del self.handlers[msg_id]
+    req = self.requests.pop(msg_id)
+    # frees up a slot for the next background request, if this one was in the background
+    self.scheduler.done(msg_id)
+    if not req:
+      self.log_client("request #" + str(msg_id) + " is no longer awaited, ignoring its response")
+      return
+    handler, call_back_into_ui_thread, req_time = req.handler, req.call_back_into_ui_thread, req.time
     def invoke_subscribed_handler(success, payload = None):
-      if callable(handler):
+      if handler is None:
+        pass
+      elif callable(handler):
         # only do async callbacks if the result is a success
         # however note that we need to ping sync callbacks in any case
         # in order to prevent freezes upon erroneous responses
@@ -556,8 +846,10 @@ class Client(ClientListener, EnsimeCommon):
         handler.payload = payload
         handler.set()
 
-    resp_time = time.time()
-    self.log_client("request #" + str(msg_id) + " took " + str(resp_time - req_time) + " seconds")
+    size, parse_time, resp_time = self._frame_stats()
+    self.env.rpc_metrics.record(req.method, latency = resp_time - req_time, response_bytes = size, parse_time = parse_time,
+                                server_time = resp_time - req.sent if req.sent else None)
+    self.log_client("request #" + str(msg_id) + " took " + str(resp_time - req_time) + " seconds (" + self.requests.stats() + ")")
     reply_type = str(payload[0])
     # (:return (:ok (:project-name nil :source-roots ("D:\\Dropbox\\Scratchpad\\Scala"))) 2)
     if reply_type == ":ok":
@@ -593,7 +885,10 @@ class Client(ClientListener, EnsimeCommon):
 
   @call_back_into_ui_thread
   def message_compiler_ready(self, msg_id, payload):
-    self.env.compiler_ready = True
+    self.env.controller.on_startup_phase(handshake.COMPILER_READY)
+    for e in self._envs():
+      e.compiler_ready = True
+      if e is not self.env: EnsimeCommon(e.w).colorize_all()
     filename = self.env.plugin_root + os.sep + "Encouragements.txt"
     lines = [line.strip() for line in open(filename)]
     msg = lines[random.randint(0, len(lines) - 1)]
@@ -613,39 +908,51 @@ class Client(ClientListener, EnsimeCommon):
   @call_back_into_ui_thread
   def message_background_message(self, msg_id, payload):
     # (:background-message 105 "Initializing Analyzer. Please wait...")
+    self.env.controller.on_startup_message(payload[1])
     self.status_message(payload[1])
 
+  def _envs(self):
+    # windows opened on the same project share this client, so notes go to each of them
+    controller = self.env.controller
+    return list(controller.envs) if controller and controller.envs else [self.env]
+
   def _update_note_ui(self):
-    self.redraw_all_highlights()
-    v = self.w.active_view()
-    if v != None:
-      self.env.notee = v
-      self.env.notes.refresh()
+    for e in self._envs():
+      EnsimeCommon(e.w).redraw_all_highlights()
+      v = e.w.active_view()
+      if v != None:
+        e.notee = v
+        e.notes.refresh()
 
   @call_back_into_ui_thread
   def message_java_notes(self, msg_id, payload):
-    self.env._notes.append(rpc.Note.parse_list(payload))
+    notes = rpc.Note.parse_list(payload)
+    for e in self._envs(): e._notes.append(notes)
     self._update_note_ui()
 
   @call_back_into_ui_thread
   def message_scala_notes(self, msg_id, payload):
-    self.env._notes.append(rpc.Note.parse_list(payload))
+    notes = rpc.Note.parse_list(payload)
+    for e in self._envs(): e._notes.append(notes)
     self._update_note_ui()
 
   @call_back_into_ui_thread
   def message_clear_all_java_notes(self, msg_id, _):
-    self.env._notes.filter(lambda n: not n.file_name.endswith(".java"))
+    for e in self._envs(): e._notes.filter(lambda n: not n.file_name.endswith(".java"))
     self._update_note_ui()
 
   @call_back_into_ui_thread
   def message_clear_all_scala_notes(self, msg_id, _):
-    self.env._notes.filter(lambda n: not n.file_name.endswith(".scala"))
+    for e in self._envs(): e._notes.filter(lambda n: not n.file_name.endswith(".scala"))
     self._update_note_ui()
 
   @call_back_into_ui_thread
   def message_debug_event(self, msg_id, payload):
     debug_event = rpc.DebugEvent.parse(payload)
-    if debug_event: self.env.debugger.handle(debug_event)
+    # the debug session belongs to the window that is running it or, before the "start" event, launching it
+    envs = self._envs()
+    debuggees = filter(lambda e: e.profile, envs) or filter(lambda e: e.profile_being_launched, envs) or [self.env]
+    if debug_event: debuggees[0].debugger.handle(debug_event)
 
   def _update_macromarkers():
     print "update macro markers"
@@ -701,7 +1008,9 @@ class ServerProcess(EnsimeCommon):
 
     env = os.environ.copy()
     args = self.env.ensime_args or "-Xms256M -Xmx1512M -XX:PermSize=128m -Xss1M -Dfile.encoding=UTF-8"
-    if not "-Densime.explode.on.disconnect" in args: args += " -Densime.explode.on.disconnect=1"
+    # the server dies when the client disconnects, unless we're going to reconnect to it
+    if not "-Densime.explode.on.disconnect" in args and not self.env.settings.get("reconnect_attempts"):
+      args += " -Densime.explode.on.disconnect=1"
     env["ENSIME_JVM_ARGS"] = str(args) # unicode not supported here
 
     if os.name =="nt":
@@ -764,16 +1073,27 @@ class ServerProcess(EnsimeCommon):
         break
 
 class Server(ServerListener, EnsimeCommon):
-  def __init__(self, owner, port_file):
+  def __init__(self, owner, port_file, quiet = False):
     super(Server, self).__init__(owner)
     self.port_file = port_file
+    self.proc = None
+    # pre-started servers haven't been asked for by the user, so they don't pop up dialogs
+    self.quiet = quiet
+    # startup timeline, which learns when the jar has been verified
+    self.profile = None
 
-  def startup(self):
+  def error_message(self, msg):
+    if self.quiet: self.log_server("Error: " + msg)
+    else: super(Server, self).error_message(msg)
+
+  def startup(self, listener = None, profile = None):
+    self.profile = profile
     ensime_command = self.get_ensime_command()
     if self.get_ensime_command() and self.verify_ensime_version():
       self.log_server("Starting Ensime server (plugin version is " + (self.env.settings.get("plugin_version") or "unknown") + ")")
       self.log_server("Launching Ensime server process with command = " + str(ensime_command) + " and args = " + str(self.env.ensime_args))
-      self.proc = ServerProcess(self.owner, ensime_command, [self, self.env.controller])
+      self.proc = ServerProcess(self.owner, ensime_command, [self, listener or self.env.controller])
+      if profile: profile.reach(handshake.SPAWNED)
       return True
 
   def get_ensime_command(self):
@@ -798,45 +1118,59 @@ class Server(ServerListener, EnsimeCommon):
     if len(ensime_jars) != 1:
       self.log_server("Error: no ensime*.jar files found in " + ensime_jar_dir)
       self.log_server("Warning: skipping the version check, proceeding with starting up the server")
+      self._verified()
       return True
-    ensime_jar = None
+    ensime_jar = ensime_jars[0]
+    cache = serverjar.JarVersionCache(self.env.plugin_root + os.sep + "jar_versions.json")
+    version = cache.lookup(ensime_jar)
+    if version:
+      self.log_server("Ensime server jar hasn't changed since it was last verified")
+      self._verified()
+      return self._check_version(version)
+    # the jar is new or has changed, so we unzip it in the background and start the server meanwhile
+    def verify():
+      try:
+        version = cache.refresh(ensime_jar)
+        sublime.set_timeout(bind(self._on_verified, version), 0)
+      except:
+        exc_type, exc_value, exc_tb = sys.exc_info()
+        detailed_info = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
+        self.log_server("Error verifying Ensime server version:" + detailed_info)
+        self.log_server("Warning: skipping the version check, proceeding with starting up the server")
+        sublime.set_timeout(self._verified, 0)
+    threading.Thread(target = verify).start()
+    return True
+
+  def _check_version(self, version):
     try:
-      ensime_jar = zipfile.ZipFile(ensime_jars[0], "r")
-      manifest = ensime_jar.open("META-INF/MANIFEST.MF", "r").readlines()
-      def parse_line(line):
-        try:
-          m = re.match(r"^(.*?):(.*)$", line)
-          return (m.group(1).strip(), m.group(2).strip())
-        except:
-          self.log_server("Problems parsing line: " + line)
-      manifest = dict(parse_line(line) for line in manifest if line.strip())
-      def parse_version(s):
-        try:
-          m = re.match(r"^(\d+)\.(\d+)(?:.(\d+)(?:.(\d+))?)?$", s)
-          return map(lambda s: int(s), filter(lambda s: s, m.groups()))
-        except:
-          self.log_server("Problems parsing version: " + s)
-      aversion = parse_version(manifest["Implementation-Version"])
-      rversion = parse_version(self.env.settings.get("min_ensime_server_version"))
-      self.log_server("Required version: " + str(rversion) + ", actual version: " + str(aversion))
-      if aversion < rversion:
-        message = "Ensime server version is " + manifest["Implementation-Version"] + ", "
-        message += "required version is at least " + str(self.env.settings.get("min_ensime_server_version")) + "."
-        message += "\n\n"
-        message += "To update your Ensime server, download a suitable version from http://download.sublimescala.org, "
-        message += "and unpack it into the \"server\" subfolder of the SublimeEnsime plugin home, which is usually located at " + sublime.packages_path() + os.sep + "Ensime. "
-        message += "Your installation is correct if inside the \"server\" subfolder there are folders named \"bin\" and \"lib\"."
-        self.error_message(message)
-        return
-      return True
+      aversion = serverjar.parse_version(version)
+      rversion = serverjar.parse_version(self.env.settings.get("min_ensime_server_version"))
     except:
-      exc_type, exc_value, exc_tb = sys.exc_info()
-      detailed_info = "".join(traceback.format_exception(exc_type, exc_value, exc_tb))
-      self.log_server("Error verifying Ensime server version:" + detailed_info)
+      self.log_server("Error verifying Ensime server version:" + traceback.format_exc())
       self.log_server("Warning: skipping the version check, proceeding with starting up the server")
       return True
-    finally:
-      if ensime_jar: ensime_jar.close()
+    self.log_server("Required version: " + str(rversion) + ", actual version: " + str(aversion))
+    if aversion < rversion:
+      message = "Ensime server version is " + version + ", "
+      message += "required version is at least " + str(self.env.settings.get("min_ensime_server_version")) + "."
+      message += "\n\n"
+      message += "To update your Ensime server, download a suitable version from http://download.sublimescala.org, "
+      message += "and unpack it into the \"server\" subfolder of the SublimeEnsime plugin home, which is usually located at " + sublime.packages_path() + os.sep + "Ensime. "
+      message += "Your installation is correct if inside the \"server\" subfolder there are folders named \"bin\" and \"lib\"."
+      self.error_message(message)
+      return
+    return True
+
+  def _verified(self):
+    if self.profile: self.profile.reach(handshake.JAR_VERIFIED)
+
+  def _on_verified(self, version):
+    self._verified()
+    if not self._check_version(version):
+      # the server has been started optimistically, so now we have to take it down
+      controller = self.env.controller
+      if controller and controller.server is self: controller.shutdown()
+      if self.proc: self.shutdown()
 
   def on_server_data(self, data):
     str_data = str(data).replace("\r\n", "\n").replace("\r", "\n")
@@ -846,71 +1180,330 @@ class Server(ServerListener, EnsimeCommon):
     self.proc.kill()
     self.proc = None
 
+class WarmServer(ServerListener, EnsimeCommon):
+  def __init__(self, owner, port_file):
+    super(WarmServer, self).__init__(owner)
+    self.port_file = port_file
+    self.server = Server(owner, port_file, quiet = True)
+    self.created = time.time()
+    self.handshake = handshake.Handshake(self.created)
+
+  def startup(self):
+    return self.server.startup(listener = self, profile = self.handshake)
+
+  def on_server_data(self, data):
+    self.handshake.feed(data)
+
+  def is_alive(self):
+    return self.server.proc and self.server.proc.poll()
+
+  def hand_over(self, controller):
+    """Redirects server output to the controller, which continues the handshake where we've left off.
+    Whatever is printed in the meanwhile is caught up with by polling the port file."""
+    controller.handshake.adopt(self.handshake)
+    # the server has been started on behalf of some window, and from now on it logs to (and is shut down by) the claiming one
+    self.server.rebind(controller.w)
+    self.server.proc.rebind(controller.w)
+    self.server.proc.listeners = [self.server, controller]
+    self.server.quiet = False
+    # the jar might still be being verified in the background
+    self.server.profile = controller.handshake
+
+class ServerPool(EnsimeCommon):
+  """Keeps a pre-started Ensime server per known project root, so that ensime_startup doesn't have to wait for a JVM.
+  Servers are launched in the background when a window with a project is opened, handed over to the controller
+  on startup, and killed if nobody has claimed them for server_pool_ttl seconds."""
+
+  def enabled(self):
+    return (self.env.settings.get("server_pool_enabled") and
+            not self.env.settings.get("connect_to_external_server", False))
+
+  def prewarm(self):
+    if not self.enabled() or not self.is_valid() or self.env.running: return
+    root = normalize_path(self.env.project_root)
+    env.serverPoolLock.acquire()
+    try:
+      if root in env.server_pool: return
+      _, port_file = tempfile.mkstemp("_ensime_port")
+      warm = WarmServer(self.owner, port_file)
+      if not warm.startup(): return
+      self.log_server("Pre-started Ensime server for " + root)
+      env.server_pool[root] = warm
+    finally:
+      env.serverPoolLock.release()
+    ttl = self.env.settings.get("server_pool_ttl") or 1800
+    sublime.set_timeout(self.sweep, int(ttl * 1000) + 1000)
+
+  def take(self):
+    if not self.enabled() or not self.env.project_root: return None
+    root = normalize_path(self.env.project_root)
+    env.serverPoolLock.acquire()
+    try:
+      warm = env.server_pool.pop(root, None)
+    finally:
+      env.serverPoolLock.release()
+    if warm and not warm.is_alive():
+      self.log_server("Pre-started Ensime server for " + root + " has died, starting a new one")
+      return None
+    return warm
+
+  def sweep(self):
+    ttl = self.env.settings.get("server_pool_ttl") or 1800
+    env.serverPoolLock.acquire()
+    try:
+      for root, warm in env.server_pool.items():
+        if not warm.is_alive() or time.time() - warm.created >= ttl:
+          self.log_server("Recycling idle pre-started Ensime server for " + root)
+          del env.server_pool[root]
+          if warm.server.proc: warm.server.shutdown()
+    finally:
+      env.serverPoolLock.release()
+
+  @staticmethod
+  def shutdown_all():
+    """Kills all pre-started servers. Nobody ever connects to them, so they wouldn't exit by themselves."""
+    env.serverPoolLock.acquire()
+    try:
+      warms = env.server_pool.values()
+      env.server_pool.clear()
+    finally:
+      env.serverPoolLock.release()
+    for warm in warms:
+      if warm.server.proc: warm.server.shutdown()
+
+# sublime calls unload_handler when the plugin is reloaded or removed
+# however it doesn't when it exits, which is what atexit is for
+def unload_handler():
+  ServerPool.shutdown_all()
+
+atexit.register(ServerPool.shutdown_all)
+
 class Controller(EnsimeCommon, ClientListener, ServerListener):
   def __init__(self, env):
     super(Controller, self).__init__(env.w)
     self.client = None
     self.server = None
+    self.handshake = None
+    # environments of all windows that use this controller (see attach)
+    self.envs = [env]
+
+  @staticmethod
+  def shared_with(e):
+    """Returns the controller that another window has started for the same project, if any."""
+    if not e.project_root: return None
+    env.controllerLock.acquire()
+    try:
+      controller = env.project_controllers.get(normalize_path(e.project_root))
+      return controller if controller and controller.envs and not e in controller.envs else None
+    finally:
+      env.controllerLock.release()
 
-  def startup(self):
+  def _register(self):
+    env.controllerLock.acquire()
+    try:
+      env.project_controllers[normalize_path(self.env.project_root)] = self
+    finally:
+      env.controllerLock.release()
+
+  def _unregister(self):
+    env.controllerLock.acquire()
+    try:
+      root = normalize_path(self.env.project_root) if self.env.project_root else None
+      if env.project_controllers.get(root) is self: del env.project_controllers[root]
+    finally:
+      env.controllerLock.release()
+
+  def _set_running(self, running):
+    for e in self.envs: e.running = running
+
+  def attach(self, e):
+    """Lets another window on the same project use this server instead of starting its own."""
+    self.log_client("Attaching window " + str(e.w.id()) + " to the Ensime server of window " + str(self.w.id()))
+    e.controller = self
+    e.running = self.env.running
+    e.compiler_ready = self.env.compiler_ready
+    e._notes.append(self.env._notes.data)
+    self.envs.append(e)
+    sublime.set_timeout(EnsimeCommon(e.w).colorize_all, 0)
+
+  def _prune(self):
+    """Forgets windows that have been closed without ensime_shutdown, so that they don't keep the server alive."""
+    alive = set([w.id() for w in sublime.windows()])
+    for e in filter(lambda e: not e.w.id() in alive, self.envs):
+      self.log_client("Window " + str(e.w.id()) + " has been closed, detaching it from the Ensime server")
+      self.envs.remove(e)
+      e.running = False
+      e.compiler_ready = False
+    self._rehome()
+
+  def _rehome(self):
+    """Hands the controller, the client and the server over to a window that still uses them,
+    once the window that has started the server is gone. Otherwise notes, colors and logs would go there."""
+    if not self.envs or self.env in self.envs: return
+    w = self.envs[0].w
+    self.log_client("Window " + str(self.w.id()) + " has handed over the Ensime server to window " + str(w.id()))
+    client_socket = self.client.socket if self.client else None
+    proc = getattr(self.server, "proc", None)
+    for obj in [self, self.client, client_socket, self.server, proc]:
+      if obj: obj.rebind(w)
+
+  def detach(self, e):
+    """Stops serving a window. The server is shut down once the last window has detached."""
+    self._prune()
+    if self.envs == [e] or not e in self.envs:
+      self.shutdown()
+      return
+    self.log_client("Detaching window " + str(e.w.id()) + " from the Ensime server of window " + str(self.w.id()))
+    self.envs.remove(e)
+    self._rehome()
+    try:
+      self._shutdown_ui(e)
+    finally:
+      e.running = False
+      e.compiler_ready = False
+
+  def _shutdown_ui(self, e):
+    try:
+      e.debugger.shutdown()
+    except:
+      self.log("Error shutting down ensime debugger:")
+      self.log(traceback.format_exc())
+    try:
+      e._notes.clear()
+      sublime.set_timeout(EnsimeCommon(e.w).uncolorize_all, 0)
+      sublime.set_timeout(e.notes.clear, 0)
+    except:
+      self.log("Error shutting down ensime UI:")
+      self.log(traceback.format_exc())
+
+  def startup(self, started = None):
     try:
       if not self.env.running:
+        self._register()
+        self.handshake = handshake.Handshake(started)
+        self.handshake.reach(handshake.CONFIG_LOADED)
         if self.env.settings.get("connect_to_external_server", False):
           self.port_file = self.env.settings.get("external_server_port_file")
-          if not self.port_file:
+          # the server might be reached via a unix domain socket or a bridge command, and then there's no port file
+          bridged = self.env.settings.get("external_server_socket") or self.env.settings.get("external_server_command")
+          if not bridged and not self.port_file:
             message = "\"connect_to_external_server\" in your Ensime.sublime-settings is set to true, "
             message += "however \"external_server_port_file\" is not specified. "
             message += "Set it to a meaningful value and restart Ensime."
             sublime.set_timeout(bind(sublime.error_message, message), 0)
             raise Exception("external_server_port_file not specified")
-          if not os.path.exists(self.port_file):
+          if not bridged and not os.path.exists(self.port_file):
             message = "\"connect_to_external_server\" in your Ensime.sublime-settings is set to true, "
             message += ("however \"external_server_port_file\" is set to a non-existent file \"" + self.port_file + "\" . ")
             message += "Check the configuration and restart Ensime."
             sublime.set_timeout(bind(sublime.error_message, message), 0)
             raise Exception("external_server_port_file not specified")
           self.server = None
-          self.env.running = True
-          sublime.set_timeout(self.ignition, 0)
+          self.handshake.reach(handshake.PORT_WRITTEN)
+          self._ignite()
         else:
-          _, port_file = tempfile.mkstemp("_ensime_port")
-          self.port_file = port_file
-          self.server = Server(self.owner, port_file)
-          self.server.startup() # delay handshake until the port number has been written
+          warm = ServerPool(self.owner).take()
+          if warm:
+            self.log_server("Using a pre-started Ensime server")
+            self.port_file = warm.port_file
+            self.server = warm.server
+            warm.hand_over(self)
+            self._await_port()
+          else:
+            _, port_file = tempfile.mkstemp("_ensime_port")
+            self.port_file = port_file
+            self.server = Server(self.owner, port_file)
+            # delay handshake until the port number has been written
+            if self.server.startup(profile = self.handshake): self._await_port()
+            else: self._abandon("Ensime server has not been started")
     except:
-      self.env.running = False
+      self._set_running(False)
+      self._unregister()
       raise
 
   def on_server_data(self, data):
-    if not self.env.running and re.search("Wrote port", data):
-      self.env.running = True
+    # output is scanned only until the port is written, after that feed returns immediately
+    if self.port_file and self.handshake.feed(data): self._ignite()
+
+  def _await_port(self):
+    """Polls the port file in case the server's output is late or doesn't mention the port,
+    which also catches the port being written while the warm server was being handed over."""
+    # the startup has been shut down meanwhile
+    if not self.port_file or not self.handshake: return
+    proc = getattr(self.server, "proc", None)
+    if self.handshake.reached(handshake.PORT_WRITTEN) or self.handshake.poll(self.port_file): self._ignite()
+    elif not proc or not proc.poll(): self._abandon("Ensime server has exited before writing its port")
+    elif time.time() - self.handshake.times[handshake.STARTED] > (self.env.settings.get("timeout_server_startup") or 120):
+      self._abandon("Ensime server hasn't written its port in time")
+    else: sublime.set_timeout(self._await_port, 100)
+
+  def _abandon(self, reason):
+    """Gives up on a startup that has failed, so that other windows on the project don't attach to a controller without a server."""
+    self.log_server(reason)
+    self.status_message(reason)
+    server, self.server = self.server, None
+    try:
+      if server and server.proc: server.shutdown()
+    finally:
+      self.shutdown()
+
+  def _ignite(self):
+    if self.handshake.ignite():
+      self._set_running(True)
       sublime.set_timeout(self.ignition, 0)
 
+  def on_startup_phase(self, phase):
+    if self.handshake and self.handshake.reach(phase):
+      if phase == handshake.COMPILER_READY:
+        self.log_client("Startup timings: " + self.handshake.summary())
+        self.env.startup_timeline.save(self.handshake)
+
+  def on_startup_message(self, message):
+    if self.handshake: self.handshake.mark(message)
+
+  def on_client_disconnected(self):
+    # called back into the UI thread by the receiver
+    # if the server is still alive, we can reconnect to it instead of paying for a cold start
+    attempts = self.env.settings.get("reconnect_attempts") or 0
+    proc = getattr(self.server, "proc", None)
+    server_alive = self.server is None or (proc is not None and proc.poll())
+    if attempts and server_alive and self.client and self.client.socket:
+      self.status_message("Ensime server has disconnected, reconnecting...")
+      self.client.reconnect(on_failure = bind(self.restart, "Cannot reconnect to Ensime server, restarting it"))
+    else:
+      self.status_message("Ensime server has disconnected")
+      self.shutdown()
+
+  def restart(self, reason, delay = 0):
+    """Restarts the server for every window that has been using it.
+    The first window starts a new server, and the others attach to it."""
+    self.log_client(reason)
+    self._prune()
+    windows = [e.w for e in self.envs]
+    self.shutdown()
+    def startup():
+      for w in windows: w.run_command("ensime_startup")
+    sublime.set_timeout(startup, delay)
+
   def ignition(self):
     timeout = self.env.settings.get("timeout_sync_roundtrip", 3)
-    self.client = Client(self.owner, self.port_file, timeout)
-    self.client.startup()
+    self.client = Client(self.owner, transport.from_settings(self.env.settings, self.port_file), timeout)
+    if self.client.startup(): self.on_startup_phase(handshake.CONNECTED)
     self.status_message("Initializing Ensime server... ")
     def init_project(subproject_name):
       conf = self.env.project_config + [key(":active-subproject"), subproject_name]
-      self.rpc.init_project(conf)
+      self.rpc.init_project(conf, lambda info: self.on_startup_phase(handshake.PROJECT_INITIALIZED))
     dotensime.select_subproject(self.env.project_config, self.owner, init_project)
 
   def shutdown(self):
+    envs = list(self.envs)
     try:
-      if self.env.running:
-        try:
-          self.env.debugger.shutdown()
-        except:
-          self.log("Error shutting down ensime debugger:")
-          self.log(traceback.format_exc())
-        try:
-          self.env._notes.clear()
-          sublime.set_timeout(self.uncolorize_all, 0)
-          sublime.set_timeout(self.env.notes.clear, 0)
-        except:
-          self.log("Error shutting down ensime UI:")
-          self.log(traceback.format_exc())
+      # startups that never got to the compiler being ready are the most interesting ones
+      if self.handshake: self.env.startup_timeline.save(self.handshake)
+      if filter(lambda e: e.running, envs):
+        for e in envs:
+          self._shutdown_ui(e)
+        self.env.rpc_stats.dump()
         try:
           if self.client:
             self.client.shutdown()
@@ -925,8 +1518,11 @@ class Controller(EnsimeCommon, ClientListener, ServerListener):
           self.log(traceback.format_exc())
     finally:
       self.port_file = None
-      self.env.running = False
-      self.env.compiler_ready = False
+      for e in envs:
+        e.running = False
+        e.compiler_ready = False
+      self.envs = []
+      self._unregister()
       self.client = None
       self.server = None
 
@@ -966,6 +1562,8 @@ class Daemon(EnsimeEventListener):
     self.redraw_status()
 
   def on_modified(self):
+    # the proxy only invokes the first listener that handles an event, so we forward this one to Completer
+    Completer(self.v).track_modification()
     rs = self.v.get_regions(ENSIME_BREAKPOINT_REGION)
     if rs:
       print "modifying breakpoit"
@@ -1201,6 +1799,24 @@ class Colorer(EnsimeCommon):
         self.env.settings.get("stackfocus_scope"),
         self.env.settings.get("stackfocus_icon"))
 
+class CompletionRequest(object):
+  def __init__(self, file_name, anchor, prefix):
+    self.file_name = file_name
+    self.anchor = anchor # start of the word being completed
+    self.prefix = prefix
+    self.msg_id = None
+    self.cancelled = False
+    self.results = None
+    self.time = time.time()
+
+  def covers(self, file_name, anchor, prefix):
+    # results for "fo" are a superset of results for "foo", and sublime filters them by itself
+    return self.file_name == file_name and self.anchor == anchor and prefix.startswith(self.prefix)
+
+  def is_stale(self, timeout):
+    # failed requests never call back, so we give up on them after a while
+    return self.results is None and time.time() - self.time > (timeout or 0)
+
 class Completer(EnsimeEventListener):
 
   def _signature_doc(self, signature):
@@ -1238,10 +1854,74 @@ class Completer(EnsimeEventListener):
             sublime.INHIBIT_EXPLICIT_COMPLETIONS |
             sublime.INHIBIT_WORD_COMPLETIONS)
 
+  def _request_completions(self, prefix, pos):
+    """Asynchronously asks ensime for completions at pos, unless there's
+    already a request for the same word. Superseded requests are cancelled.
+    Patching the source and talking to the server happen off the UI thread,
+    on a single worker, so that patches reach the server in the order they were made."""
+    file_name = self.v.file_name()
+    anchor = pos - len(prefix)
+    req = self.env.completion_request
+    timeout = self.env.settings.get("timeout_completions")
+    if req and req.results is None and req.covers(file_name, anchor, prefix) and not req.is_stale(timeout):
+      return req
+    self._cancel_completions()
+    req = CompletionRequest(file_name, anchor, prefix)
+    self.env.completion_request = req
+    contents = self.v.substr(Region(0, self.v.size())) if self.v.is_dirty() else None
+    on_complete = bind(self._completions_received, req)
+    # settings can only be read on the UI thread
+    default_timeout = self.env.settings.get("timeout_async_requests") or 600
+    patch_timeout = self.env.settings.get("timeout_patch_source") or default_timeout
+    completions_timeout = timeout or default_timeout
+    client = self.env.controller.client
+    def send():
+      # a superseded request doesn't need its patch either, the next one brings the latest contents
+      if req.cancelled: return
+      try:
+        if contents is not None:
+          self.rpc.patch_source(file_name, diff.diff_text_with_disk(file_name, contents), timeout = patch_timeout)
+        if not req.cancelled:
+          req.msg_id = self.rpc.completions(file_name, pos, 0, False, False, on_complete, timeout = completions_timeout)
+          # might have been superseded while we were sending
+          if req.cancelled: client.cancel(req.msg_id)
+      except:
+        self.log_client("failed to request completions")
+        self.log_client(traceback.format_exc())
+    self.env.completion_queue.submit(send)
+    return req
+
+  def _cancel_completions(self):
+    req = self.env.completion_request
+    if req and req.results is None:
+      req.cancelled = True
+      if req.msg_id is not None and self.env.controller and self.env.controller.client:
+        self.env.controller.client.cancel(req.msg_id)
+
+  def _completions_received(self, req, completions):
+    if req.cancelled or req is not self.env.completion_request: return
+    req.results = completions or []
+    if not req.results and req.prefix:
+      self.env.completion_ignore_prefix = req.prefix
+    # only bring the pop-up up if the user is still typing the word we've been asked about
+    sel = self.v.sel()
+    if self.w.active_view() is None or self.w.active_view().id() != self.v.id(): return
+    if len(sel) != 1 or not sel[0].empty(): return
+    pos = sel[0].begin()
+    if pos < req.anchor or not re.match(r"^\w*$", self.v.substr(Region(req.anchor, pos))): return
+    self.env.completion_cache.store(req.file_name, req.anchor, req.prefix,
+                                    self.v.change_count(), self.v.size(), pos, req.results)
+    self.v.run_command("hide_auto_complete")
+    self.v.run_command("auto_complete", {
+      "disable_auto_insert": True,
+      "api_completions_only": True,
+      "next_completion_if_showing": False})
+
   def _query_completions(self, prefix, locations):
-    """Query the ensime API for completions. Note: we must ask for _all_
-    completions as sublime will not re-query unless this query returns an
-    empty list."""
+    """Serve completions from the completion cache. Note: we must ask for
+    _all_ completions as sublime will not re-query unless this query returns
+    an empty list. On a cache miss, we return an empty list, ask ensime
+    and re-show the pop-up when the results arrive."""
     # Short circuit for prefix that is known to return empty list
     # TODO(aemoncannon): Clear ignore prefix if the user
     # moves point to new context.
@@ -1250,13 +1930,14 @@ class Completer(EnsimeEventListener):
       return self._completion_response([])
     else:
       self.env.completion_ignore_prefix = None
-    if self.v.is_dirty():
-      edits = diff.diff_view_with_disk(self.v)
-      self.rpc.patch_source(self.v.file_name(), edits)
-    completions = self.rpc.completions(self.v.file_name(), locations[0], 0, False, False)
-    if not completions:
-      self.env.completion_ignore_prefix = prefix
-    return self._completion_response(completions)
+    anchor = locations[0] - len(prefix)
+    cache = self.env.completion_cache
+    cached = cache.lookup(self.v.file_name(), anchor, prefix, self.v.change_count())
+    if cached is not None:
+      return self._completion_response(cached)
+    self.log_client(cache.stats())
+    self._request_completions(prefix, locations[0])
+    return self._completion_response([])
 
   def on_query_completions(self, prefix, locations):
     if self.env.running and self.in_project():
@@ -1264,6 +1945,19 @@ class Completer(EnsimeEventListener):
     else:
       return []
 
+  def track_modification(self):
+    """Drops cached completions unless the edit stays within the word being completed.
+    Also fires a completion request as soon as a trigger character is typed,
+    so that the results are likely to be ready by the time sublime asks."""
+    if not (self.is_running() and self.in_project()): return
+    sel = self.v.sel()
+    pos = sel[0].begin() if len(sel) == 1 and sel[0].empty() else None
+    self.env.completion_cache.on_modified(self.v.file_name(), self.v.change_count(), self.v.size(), pos,
+                                          lambda begin, end: self.v.substr(Region(begin, end)))
+    triggers = self.env.settings.get("completion_triggers") or []
+    if pos and self.v.substr(pos - 1) in triggers:
+      self._request_completions("", pos)
+
 ############################## SUBLIME COMMANDS: MAINTENANCE ##############################
 
 class EnsimeStartup(EnsimeWindowCommand):
@@ -1271,6 +1965,7 @@ class EnsimeStartup(EnsimeWindowCommand):
     return not self.env.running
 
   def run(self):
+    started = time.time()
     # refreshes the config (fixes #29)
     self.env.recalc()
 
@@ -1279,17 +1974,23 @@ class EnsimeStartup(EnsimeWindowCommand):
       error_handler()
       return
 
+    # windows opened on the same project share a single server
+    shared = Controller.shared_with(self.env)
+    if shared:
+      shared.attach(self.env)
+      return
+
     self.env.controller = Controller(self.env)
-    self.env.controller.startup()
+    self.env.controller.startup(started)
 
 class EnsimeShutdown(RunningOnly, EnsimeWindowCommand):
   def run(self):
-    self.env.controller.shutdown()
+    self.env.controller.detach(self.env)
 
 class EnsimeRestart(RunningOnly, EnsimeWindowCommand):
   def run(self):
-    self.w.run_command("ensime_shutdown")
-    sublime.set_timeout(bind(self.w.run_command, "ensime_startup"), 100)
+    # unlike ensime_shutdown, this restarts the server for all windows that share it
+    self.env.controller.restart("Restarting Ensime server on request of window " + str(self.w.id()), 100)
 
 class EnsimeCreateProjectFromScratch(NotRunningOnly, EnsimeWindowCommand):
   def run(self):
@@ -1333,6 +2034,88 @@ class EnsimeShowServerLog(EnsimeWindowCommand):
   def run(self):
     _show_log(self, "server.log")
 
+class EnsimeShowRpcStats(EnsimeWindowCommand):
+  def is_enabled(self):
+    return self.is_valid()
+
+  def run(self):
+    self.env.rpc_stats.dump()
+    self.env.rpc_stats.show()
+    self.env.rpc_stats.refresh()
+
+class RpcStats(EnsimeToolView):
+  def can_show(self):
+    return True
+
+  @property
+  def name(self):
+    return ENSIME_RPC_STATS_VIEW
+
+  @property
+  def dump_file(self):
+    return self.env.log_root + os.sep + "rpc_stats.json"
+
+  def dump(self):
+    try:
+      if not os.path.exists(self.env.log_root): os.makedirs(self.env.log_root)
+      self.env.rpc_metrics.dump(self.dump_file)
+    except:
+      self.log_client("Error dumping RPC stats:")
+      self.log_client(traceback.format_exc())
+
+  def render(self):
+    since = datetime.datetime.fromtimestamp(self.env.rpc_metrics.since).strftime("%Y-%m-%d %H:%M:%S")
+    lines = []
+    lines.append("RPC stats since " + since + " (also dumped to " + self.dump_file + ")")
+    lines.append("")
+    lines.append(self.env.rpc_metrics.render())
+    return "\n".join(lines)
+
+class EnsimeShowStartupTimeline(EnsimeWindowCommand):
+  def is_enabled(self):
+    return self.is_valid()
+
+  def run(self):
+    self.env.startup_timeline.show()
+    self.env.startup_timeline.refresh()
+
+class StartupTimeline(EnsimeToolView):
+  def can_show(self):
+    return True
+
+  @property
+  def name(self):
+    return ENSIME_STARTUP_TIMELINE_VIEW
+
+  @property
+  def history(self):
+    return handshake.StartupHistory(self.env.log_root + os.sep + "startup_timeline.json",
+                                    self.env.settings.get("startup_history_size") or 20)
+
+  def _classpath_size(self):
+    m = sexp.sexp_to_key_map(self.env.project_config)
+    configs = [m] + [sexp.sexp_to_key_map(p) for p in m.get(":subprojects", [])]
+    keys = [":compile-deps", ":compile-jars", ":runtime-deps", ":runtime-jars", ":test-deps"]
+    return sum([len(c.get(k) or []) for c in configs for k in keys])
+
+  def save(self, profile):
+    if profile.saved: return
+    profile.saved = True
+    try:
+      if not os.path.exists(self.env.log_root): os.makedirs(self.env.log_root)
+      self.history.append(profile.to_json(project = self.env.project_root, classpath = self._classpath_size()))
+    except:
+      self.log_client("Error saving startup timeline:")
+      self.log_client(traceback.format_exc())
+
+  def render(self):
+    lines = []
+    lines.append("Latest Ensime startups (also saved to " + self.history.path + ")")
+    lines.append("Columns are: time since ensime_startup, time spent in the phase, phase or a message from the server")
+    lines.append("")
+    lines.append(self.history.render())
+    return "\n".join(lines)
+
 class EnsimeHighlight(RunningOnly, EnsimeWindowCommand):
   def run(self, enable = True):
     self.env.settings.set("error_highlight", not not enable)
@@ -1882,6 +2665,8 @@ class Debugger(EnsimeCommon):
         self.env.profile = self.env.profile_being_launched
         self.backup_layout("debug_layout_when_leaving_debugmode")
         self.apply_layout("debug_layout_when_entering_debugmode")
+      # from now on events are routed to this window by its profile
+      self.env.profile_being_launched = None
     elif event.type == "death" or event.type == "disconnect":
       if self.env.profile: # this condition here is just to mirror the coniditon in event.type == "start"
         self.shutdown(erase_dashboard = False) # so that people can take a look later
@@ -1934,6 +2719,7 @@ class Debugger(EnsimeCommon):
                 self.type = "start"
             self.handle(FakeStartEvent())
         else:
+          self.env.profile_being_launched = None
           self.status_message("Debugger has failed to start" + launch_name + ". " + str(status.details))
       self.rpc.debug_start(launch, self.env.breakpoints, callback)
     else:
@@ -2187,20 +2973,26 @@ class WatchValueArrayNode(WatchValueCollectionNode):
     return self.value.length
 
   def enumerate_elements(self):
-    for i in range(self.start, self.value.length):
-      key = "[" + str(i) + "]"
-      value = self.rpc.debug_value(DebugLocationElement(self.value.object_id, i))
-      yield (key, value)
+    # elements past the threshold aren't shown, so there's no point in requesting them
+    # (the one right after it is still consumed by enumerate_children to detect the overflow)
+    threshold = self.env.settings.get("debug_max_collection_elements_to_show", 0)
+    end = min(self.value.length, self.start + threshold + 1) if threshold > 0 else self.value.length
+    batch = self.rpc.batch()
+    for i in range(self.start, end):
+      batch.debug_value(DebugLocationElement(self.value.object_id, i))
+    for i, value in zip(range(self.start, end), batch.wait()):
+      yield ("[" + str(i) + "]", value)
 
 class WatchValueObjectNode(WatchValueReferenceNode):
   def __init__(self, env, parent, label, value):
     super(WatchValueObjectNode, self).__init__(env, parent, label, value)
 
   def enumerate_children(self):
+    batch = self.rpc.batch()
     for field in self.value.fields:
-      key = field.name
-      value = self.rpc.debug_value(DebugLocationField(self.value.object_id, field.name))
-      yield (key, value)
+      batch.debug_value(DebugLocationField(self.value.object_id, field.name))
+    for field, value in zip(self.value.fields, batch.wait()):
+      yield (field.name, value)
 
 def create_watch_value_node(env, parent, label, value):
   if str(value.type) == "null":
@@ -2233,15 +3025,17 @@ class WatchRoot(WatchNode):
 
   def load_children(self):
     if self.env.stackframe:
+      # TODO: this, along with other stuff in WatchValueNode, should really be asynchronous
+      # if you implement this, make sure to use batch.send instead of batch.wait
+      labels = []
+      batch = self.rpc.batch()
       if self.env.stackframe.this_object_id != "-1": # supposedly, this stands for "invalid value"
-        value = self.rpc.debug_value(DebugLocationReference(self.env.stackframe.this_object_id))
-        yield create_watch_value_node(self.env, self, "this", value)
+        labels.append("this")
+        batch.debug_value(DebugLocationReference(self.env.stackframe.this_object_id))
       for i, local in enumerate(self.env.stackframe.locals):
-        label = local.name
-        # TODO: this, along with other stuff in WatchValueNode, should really be asynchronous
-        # if you implement this, make sure to change correspond method signatures in rpc.py
-        # to say "@async_rpc" instead of "@sync_rpc"
-        value = self.rpc.debug_value(DebugLocationSlot(self.env.backtrace.thread_id, self.env.stackframe.index, i))
+        labels.append(local.name)
+        batch.debug_value(DebugLocationSlot(self.env.backtrace.thread_id, self.env.stackframe.index, i))
+      for label, value in zip(labels, batch.wait()):
         yield create_watch_value_node(self.env, self, label, value)
 
 class Watches(EnsimeToolView):
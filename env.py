@@ -1,12 +1,20 @@
 import sublime
 import threading, uuid
 from uuid import uuid4
-import dotensime, dotsession
+import dotensime, dotsession, completions, metrics
 from paths import *
 
 envLock = threading.RLock()
 ensime_envs = {}
 
+# controllers keyed by normalized project root, shared by all windows opened on the same project
+controllerLock = threading.RLock()
+project_controllers = {}
+
+# pre-started servers keyed by normalized project root (see ensime.ServerPool)
+serverPoolLock = threading.RLock()
+server_pool = {}
+
 def for_window(window):
   if window:
     if window.id() in ensime_envs:
@@ -30,9 +38,10 @@ class EnsimeEnvironment(object):
 
   def __deferred_init__(self):
     self.recalc()
-    from ensime import Daemon
+    from ensime import Daemon, ServerPool
     v = self.w.active_view()
     if v != None: Daemon(v).on_activated() # recolorize
+    ServerPool(self.w).prewarm()
 
   @property
   def project_root(self):
@@ -86,6 +95,7 @@ class EnsimeEnvironment(object):
     self.running = False
     self.controller = None # injected by EnsimeStartup to ensure smooth reloading
     self.compiler_ready = False
+    self.rpc_metrics = metrics.RpcMetrics()
 
     # TODO: find a better place for this beast
     class NoteStorage(object):
@@ -127,6 +137,11 @@ class EnsimeEnvironment(object):
     # completion results. Use this so we don't repeatedly hit ensime for results
     # that don't exist.
     self.completion_ignore_prefix = None
+    # The completion request that is either in flight or has most recently finished.
+    # Superseded requests are cancelled, so that their results don't overwrite fresher ones.
+    self.completion_request = None
+    self.completion_cache = completions.CompletionCache()
+    self.completion_queue = completions.SendQueue("ensime-completions-" + str(self.w.id()))
 
     # debugger stuff (mutable)
     # didn't prefix it with "debugger_", because there are no name clashes yet
@@ -191,6 +206,16 @@ class EnsimeEnvironment(object):
     from ensime import Watches
     return Watches(self)
 
+  @property
+  def rpc_stats(self):
+    from ensime import RpcStats
+    return RpcStats(self)
+
+  @property
+  def startup_timeline(self):
+    from ensime import StartupTimeline
+    return StartupTimeline(self)
+
   # externalizable part of mutable state
 
   def load_session(self):
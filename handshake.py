@@ -0,0 +1,223 @@
+import os, threading, time, json, datetime
+
+STARTED = "started"
+CONFIG_LOADED = "config loaded"
+JAR_VERIFIED = "server jar verified"
+SPAWNED = "spawned"
+PORT_WRITTEN = "port written"
+CONNECTED = "connected"
+PROJECT_INITIALIZED = "project initialized"
+COMPILER_READY = "compiler ready"
+PHASES = [STARTED, CONFIG_LOADED, JAR_VERIFIED, SPAWNED, PORT_WRITTEN, CONNECTED, PROJECT_INITIALIZED, COMPILER_READY]
+
+class Handshake(object):
+  """Tracks the startup of a server from ensime_startup to the compiler being ready.
+  The port is considered written when either the server says so on stdout or the port file
+  gets a port number in it, whichever comes first. Every phase is timestamped once,
+  and server-side progress reports along the way are kept as milestones."""
+
+  marker = "Wrote port"
+
+  def __init__(self, started = None):
+    self.times = {STARTED: started or time.time()}
+    self.milestones = []
+    self.saved = False
+    self._tail = ""
+    self._port = None
+    self._ignited = False
+    self._lock = threading.Lock()
+
+  def reached(self, phase):
+    return phase in self.times
+
+  def reach(self, phase):
+    """Timestamps the phase. Returns False if it has already been reached,
+    so that the caller can act on a transition exactly once."""
+    self._lock.acquire()
+    try:
+      if phase in self.times: return False
+      self.times[phase] = time.time()
+      if phase == PORT_WRITTEN: self._tail = ""
+      return True
+    finally:
+      self._lock.release()
+
+  def adopt(self, other):
+    """Continues a handshake that has been started by someone else, e.g. by a pre-started server.
+    Its phases keep their timestamps, so they show up as having happened before we started."""
+    self._lock.acquire()
+    try:
+      for phase, at in other.times.iteritems():
+        if phase != STARTED: self.times.setdefault(phase, at)
+      self._tail = other._tail
+      self._port = other._port
+    finally:
+      self._lock.release()
+
+  def mark(self, label):
+    if not COMPILER_READY in self.times: self.milestones.append((label, time.time()))
+
+  def ignite(self):
+    """Returns True exactly once, to the first of the threads that want to connect to the server."""
+    self._lock.acquire()
+    try:
+      if self._ignited or not PORT_WRITTEN in self.times: return False
+      self._ignited = True
+      return True
+    finally:
+      self._lock.release()
+
+  def feed(self, data):
+    """Scans a chunk of server output for the marker. Chunks are cut at arbitrary places,
+    so we carry the end of the previous chunk over. Once the port is written, output isn't scanned anymore.
+    Returns True if this chunk has completed the handshake."""
+    if PORT_WRITTEN in self.times: return False
+    window = self._tail + data
+    if self.marker in window: return self.reach(PORT_WRITTEN)
+    self._tail = window[-(len(self.marker) - 1):]
+    return False
+
+  def poll(self, port_file):
+    """Checks whether the port file has got the port number in it.
+    The server might be in the middle of writing it, and "42" might be the beginning of "4242",
+    so the number only counts when it ends with a newline or reads the same on two consecutive polls.
+    Returns True if this check has completed the handshake."""
+    if PORT_WRITTEN in self.times or not port_file: return False
+    try:
+      with open(port_file) as f: contents = f.read()
+      int(contents)
+    except (EnvironmentError, ValueError):
+      # not there yet
+      self._port = None
+      return False
+    complete = contents.endswith("\n") or contents == self._port
+    self._port = contents
+    return complete and self.reach(PORT_WRITTEN)
+
+  def timings(self):
+    start = self.times[STARTED]
+    return [(phase, self.times[phase] - start) for phase in PHASES if phase in self.times]
+
+  def summary(self):
+    return ", ".join(["%s %+.1fs" % (phase, elapsed) for phase, elapsed in self.timings()])
+
+  def to_json(self, **details):
+    """Flattens phases and milestones into a single timeline of [label, seconds since start, is milestone]."""
+    start = self.times[STARTED]
+    events = [[phase, self.times[phase] - start, False] for phase in PHASES if phase in self.times]
+    events += [[label, at - start, True] for label, at in self.milestones]
+    events.sort(key = lambda e: e[1])
+    result = {"started": start, "completed": COMPILER_READY in self.times, "events": events}
+    result.update(details)
+    return result
+
+class StartupHistory(object):
+  """The last few startup timelines, persisted as JSON, so that regressions
+  (e.g. after the classpath in .ensime has grown) can be spotted across sessions."""
+
+  def __init__(self, path, size = 20):
+    self.path = path
+    self.size = size
+
+  def load(self):
+    try:
+      with open(self.path) as f: return json.load(f)
+    except (EnvironmentError, ValueError):
+      return []
+
+  def append(self, timeline):
+    startups = (self.load() + [timeline])[-self.size:]
+    with open(self.path, "w") as f:
+      json.dump(startups, f, indent = 2)
+
+  def render(self, width = 40):
+    startups = self.load()
+    if not startups: return "No startups have been recorded yet"
+    lines = []
+    # the latest startup comes first
+    for startup in reversed(startups):
+      events = startup["events"]
+      total = events[-1][1] if events else 0
+      when = datetime.datetime.fromtimestamp(startup["started"]).strftime("%Y-%m-%d %H:%M:%S")
+      outcome = ("compiler ready after %.1fs" % total) if startup.get("completed") else ("abandoned after %.1fs" % total)
+      header = when + "  " + str(startup.get("project")) + "  (" + outcome
+      if startup.get("classpath") is not None: header += ", " + str(startup["classpath"]) + " classpath entries"
+      lines.append(header + ")")
+      previous = 0
+      for label, elapsed, milestone in events:
+        # pre-started servers have spawned before the startup, and that's not on us
+        delta = max(elapsed - max(previous, 0), 0) if elapsed >= 0 else 0
+        bar = "#" * int(round(width * delta / total)) if total > 0 else ""
+        lines.append(("  %+9.2fs %+8.2fs  %-40s %s" % (elapsed, delta, ("  " if milestone else "") + label, bar)).rstrip())
+        previous = elapsed
+      lines.append("")
+    return "\n".join(lines)
+
+def _check_handshake():
+  import tempfile
+  # the marker straddles two chunks
+  h = Handshake()
+  assert not h.feed("[INFO] Server listening...\nWro")
+  assert h.feed("te port 4242 to /tmp/port\n")
+  assert not h.feed("Wrote port") # only once
+  assert not Handshake().ignite()
+  # chunks smaller than the marker
+  h = Handshake()
+  assert [h.feed(c) for c in "xWrote portx"].count(True) == 1
+  # the port file wins the race
+  fd, port_file = tempfile.mkstemp("_ensime_port")
+  try:
+    h = Handshake()
+    assert not h.poll(port_file)
+    # caught in the middle of writing the port
+    os.write(fd, "42")
+    assert not h.poll(port_file)
+    os.write(fd, "42")
+    assert not h.poll(port_file)
+    # no newline, but the number hasn't changed since the last poll
+    assert h.poll(port_file)
+    assert not h.feed("Wrote port")
+    assert h.ignite() and not h.ignite()
+    # a newline terminates the number right away
+    os.write(fd, "\n")
+    assert Handshake().poll(port_file)
+  finally:
+    os.close(fd)
+    os.remove(port_file)
+  # a pre-started server has spawned and written its port before the startup
+  h.reach(SPAWNED)
+  later = Handshake(time.time() + 1)
+  later.adopt(h)
+  assert later.reached(PORT_WRITTEN) and later.timings()[1][1] < 0
+  assert later.ignite()
+  h = later
+  for phase in [CONFIG_LOADED, JAR_VERIFIED, CONNECTED]: h.reach(phase)
+  h.mark("Initializing Analyzer. Please wait...")
+  for phase in [COMPILER_READY, PROJECT_INITIALIZED]: assert h.reach(phase)
+  h.mark("too late")
+  assert not h.reach(CONNECTED)
+  assert sorted([phase for phase, _ in h.timings()]) == sorted(PHASES), h.timings()
+  assert [label for label, _, milestone in h.to_json()["events"] if milestone] == ["Initializing Analyzer. Please wait..."]
+
+def _check_history():
+  import tempfile
+  fd, path = tempfile.mkstemp("_startup_timeline.json")
+  os.close(fd)
+  try:
+    history = StartupHistory(path, size = 3)
+    assert history.load() == [] # empty file
+    for i in xrange(5):
+      h = Handshake(time.time() - 10)
+      h.reach(CONFIG_LOADED)
+      h.mark("Initializing Analyzer. Please wait...")
+      if i % 2 == 0: h.reach(COMPILER_READY)
+      history.append(h.to_json(project = "/work/project" + str(i), classpath = 100 * i))
+    startups = history.load()
+    assert [s["project"] for s in startups] == ["/work/project2", "/work/project3", "/work/project4"]
+    return history.render()
+  finally:
+    os.remove(path)
+
+if __name__ == "__main__":
+  _check_handshake()
+  print _check_history()
@@ -0,0 +1,131 @@
+import threading, json, time
+
+class Histogram(object):
+  """HDR-style histogram of non-negative integers.
+  Values are bucketed by their highest bits: every power of two is split into
+  the same number of linear sub-buckets, so the relative error of a percentile
+  is bounded by 1/2**(sub_bucket_bits - 1) regardless of magnitude,
+  and memory doesn't grow with the number of recorded values."""
+
+  def __init__(self, sub_bucket_bits = 6):
+    self.sub_bucket_bits = sub_bucket_bits
+    self.buckets = {} # (shift, mantissa) -> count
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = None
+
+  def record(self, value):
+    value = max(int(value), 0)
+    shift = 0
+    limit = 1 << self.sub_bucket_bits
+    while (value >> shift) >= limit: shift += 1
+    bucket = (shift, value >> shift)
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min: self.min = value
+    if self.max is None or value > self.max: self.max = value
+
+  def mean(self):
+    return float(self.total) / self.count if self.count else 0.0
+
+  def percentile(self, p):
+    """Returns the highest value that is equivalent (i.e. shares the bucket) to the p-th percentile."""
+    if not self.count: return 0
+    rank = max(1, int(round(p / 100.0 * self.count + 0.5 - 1e-9)))
+    seen = 0
+    for (shift, mantissa) in sorted(self.buckets, key = lambda b: b[1] << b[0]):
+      seen += self.buckets[(shift, mantissa)]
+      if seen >= rank:
+        return min(((mantissa + 1) << shift) - 1, self.max)
+    return self.max
+
+  def to_json(self):
+    return {"count": self.count, "total": self.total, "min": self.min, "max": self.max,
+            "mean": self.mean(), "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99)}
+
+# times are recorded in microseconds, sizes in bytes
+TIMES = ["latency", "queue_wait", "server_time", "parse_time"]
+SIZES = ["request_bytes", "response_bytes"]
+
+class RpcMetrics(object):
+  """Histograms of RPC timings and sizes keyed by swank method name
+  (e.g. swank:completions) or, for unsolicited messages, by message type (e.g. :typecheck-result)."""
+
+  def __init__(self):
+    self.methods = {}
+    self.since = time.time()
+    self._lock = threading.Lock()
+
+  def record(self, method, **values):
+    self._lock.acquire()
+    try:
+      histograms = self.methods.get(method)
+      if histograms is None:
+        histograms = dict((name, Histogram()) for name in TIMES + SIZES)
+        self.methods[method] = histograms
+      for name, value in values.iteritems():
+        if value is None: continue
+        if name in TIMES: value = value * 1000000
+        histograms[name].record(value)
+    finally:
+      self._lock.release()
+
+  def to_json(self):
+    self._lock.acquire()
+    try:
+      return {"since": self.since, "methods": dict(
+        (method, dict((name, h.to_json()) for name, h in histograms.iteritems() if h.count))
+        for method, histograms in self.methods.iteritems())}
+    finally:
+      self._lock.release()
+
+  def dump(self, path):
+    with open(path, "w") as f:
+      json.dump(self.to_json(), f, indent = 2, sort_keys = True)
+
+  def render(self):
+    data = self.to_json()["methods"]
+    def worst(method):
+      latency = data[method].get("latency")
+      return -(latency["total"] if latency else 0)
+    lines = []
+    header = "%-36s %7s %9s %9s %9s %9s %9s %9s %9s" % (
+      "method", "count", "p50 ms", "p95 ms", "p99 ms", "queue ms", "server ms", "parse ms", "resp KB")
+    lines.append(header)
+    lines.append("-" * len(header))
+    # calls that cost us most in total come first
+    for method in sorted(data, key = worst):
+      stats = data[method]
+      def ms(name, p = "p50"):
+        return "%.1f" % (stats[name][p] / 1000.0) if name in stats else "-"
+      count = max([h["count"] for h in stats.values()] or [0])
+      kb = "%.1f" % (stats["response_bytes"]["total"] / 1024.0) if "response_bytes" in stats else "-"
+      lines.append("%-36s %7d %9s %9s %9s %9s %9s %9s %9s" % (
+        method, count, ms("latency"), ms("latency", "p95"), ms("latency", "p99"),
+        ms("queue_wait"), ms("server_time"), ms("parse_time"), kb))
+    return "\n".join(lines)
+
+def _check_histogram():
+  import random
+  r = random.Random(42)
+  values = [int(r.expovariate(1.0 / 5000)) for i in xrange(100000)]
+  h = Histogram()
+  for v in values: h.record(v)
+  values.sort()
+  for p in [50, 95, 99, 99.9]:
+    exact = values[int(p / 100.0 * len(values)) - 1]
+    approx = h.percentile(p)
+    assert abs(approx - exact) <= exact / 32.0 + 1, (p, approx, exact)
+  assert h.count == len(values) and h.max == values[-1] and h.min == values[0]
+  # memory is bounded by the number of buckets rather than by the number of values
+  assert len(h.buckets) < 64 * 16, len(h.buckets)
+
+if __name__ == "__main__":
+  _check_histogram()
+  m = RpcMetrics()
+  for i in xrange(1000):
+    m.record("swank:completions", latency = 0.05 + i / 10000.0, request_bytes = 120, response_bytes = 30000)
+  m.record(":typecheck-result", response_bytes = 5000, parse_time = 0.002)
+  print m.render()
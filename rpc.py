@@ -1,4 +1,5 @@
-import inspect, functools
+import inspect, functools, threading, time, heapq
+from itertools import izip
 from functools import partial as bind
 import sexp
 from sexp import key, sym
@@ -7,10 +8,22 @@ from paths import *
 ############################## DATA STRUCTURES ##############################
 
 class ActiveRecord(object):
+  # lazy records keep the raw sexp around and only decode it
+  # when one of their fields is accessed for the first time
+  # this pays off for big replies (e.g. types with hundreds of members),
+  # of which the UI typically reads only a couple of fields
+  lazy = False
+
+  # records that declare a schema are decoded by a function compiled from the declaration
+  # the decoder makes a single pass over the raw plist without building an intermediate key map
+  # every field is a tuple (keyword, attribute, default, converter), where the last two are optional
+  # fields without a default (or with the default of REQUIRED) must be present in the plist
+  schema = None
+
   @classmethod
   def parse_list(cls, raw):
     if not raw: return []
-    if type(raw[0]) == type(key(":key")):
+    if type(raw[0]) == sexp.Keyword:
       m = sexp.sexp_to_key_map(raw)
       field = ":" + cls.__name__.lower() + "s"
       return [cls.parse(raw) for raw in (m[field] if field in m else [])]
@@ -20,35 +33,103 @@ class ActiveRecord(object):
   @classmethod
   def parse(cls, raw):
     if not raw: return None
-    m = sexp.sexp_to_key_map(raw)
     self = cls()
-    populate = getattr(self, "populate")
-    populate(m)
+    if cls.lazy: self._raw = raw
+    elif cls.schema: (_decoders.get(cls) or compile_decoder(cls))(self, raw)
+    else: self._populate(raw)
     return self
 
+  def _populate(self, raw):
+    if self.schema:
+      decode = _decoders.get(type(self)) or compile_decoder(type(self))
+      decode(self, raw)
+    else:
+      m = sexp.sexp_to_key_map(raw)
+      populate = getattr(self, "populate")
+      populate(m)
+
+  def validate(self):
+    pass
+
+  def _force(self):
+    raw = self.__dict__.pop("_raw", None)
+    if raw: self._populate(raw)
+    return not not raw
+
+  def __getattr__(self, name):
+    # only called for missing attributes, i.e. for fields of a lazy record that hasn't been decoded yet
+    if not name.startswith("__") and self._force(): return getattr(self, name)
+    raise AttributeError(name)
+
   def unparse(self):
     raise Exception("abstract method: ActiveRecord.unparse")
 
   def __str__(self):
+    self._force()
     return str(self.__dict__)
 
+REQUIRED = object()
+
+_decoders = {}
+
+def compile_decoder(cls):
+  """Compile a decoder for the given record class from its `schema`
+  and register it, so that subsequent parses reuse it.
+  The decoder is generated as Python source specialized for the class: fields live in locals,
+  keywords are compared by identity in an unrolled chain, and the record's dict is written once at the end."""
+  names, values = ["REQUIRED", "izip"], [REQUIRED, izip]
+  init, dispatch, checks, stores = [], [], [], []
+  for i, field in enumerate(cls.schema):
+    keyword, attr = field[0], field[1]
+    default = field[2] if len(field) > 2 else REQUIRED
+    convert = field[3] if len(field) > 3 else None
+    names += ["k%d" % i, "d%d" % i]
+    values += [key(keyword), default]
+    # mutable defaults must not be shared between records
+    init.append(("    f%d = list(d%d)" if type(default) == list else "    f%d = d%d") % (i, i))
+    if convert:
+      names.append("c%d" % i)
+      values.append(convert)
+    dispatch.append("      %s k is k%d: f%d = %s" % ("elif" if dispatch else "if", i, i, ("c%d(v)" % i) if convert else "v"))
+    if default is REQUIRED: checks.append("    if f%d is REQUIRED: raise KeyError(%r)" % (i, keyword))
+    stores.append("    d[%r] = f%d" % (attr, i))
+  if cls.validate.im_func is not ActiveRecord.validate.im_func: stores.append("    self.validate()")
+  # the constants are passed to a factory, so that the decoder reads them from its closure rather than from globals
+  source = "\n".join(
+    ["def make(%s):" % ", ".join(names),
+     "  def decode(self, raw):",
+     "    if type(raw) != list or len(raw) % 2: raise Exception(\"not a sexp: %s\" % (raw,))"] +
+    init +
+    ["    it = iter(raw)",
+     "    for k, v in izip(it, it):"] +
+    dispatch + checks +
+    ["    d = self.__dict__"] +
+    stores +
+    ["  return decode"]) + "\n"
+  env = {}
+  exec compile(source, "<decoder for %s>" % cls.__name__, "exec") in env
+  decode = env["make"](*values)
+  decode.source = source
+  _decoders[cls] = decode
+  return decode
+
 class Note(ActiveRecord):
-  def populate(self, m):
-    self.message = m[":msg"]
-    self.file_name = m[":file"]
-    self.severity = m[":severity"]
-    self.start = m[":beg"]
-    self.end = m[":end"]
-    self.line = m[":line"]
-    self.col = m[":col"]
+  schema = [
+    (":msg", "message"),
+    (":file", "file_name"),
+    (":severity", "severity"),
+    (":beg", "start"),
+    (":end", "end"),
+    (":line", "line"),
+    (":col", "col")]
 
 class Completion(ActiveRecord):
-  def populate(self, m):
-    self.name = m[":name"]
-    self.signature = m[":type-sig"]
-    self.is_callable = bool(m[":is-callable"]) if ":is-callable" in m else False
-    self.type_id = m[":type-id"]
-    self.to_insert = m[":to-insert"] if ":to-insert" in m else None
+  schema = [
+    (":name", "name"),
+    (":type-sig", "signature"),
+    (":is-callable", "is_callable", False, bool),
+    (":type-id", "type_id"),
+    (":to-insert", "to_insert", None)]
 
 #Macros 
 #to be adapted to the new protocol on server-side
@@ -68,25 +149,28 @@ class MacroMarkers(ActiveRecord):
     self.pos = SourcePosition.parse_list(m[":macro-positions"]) if ":macro-positions" in m else None
 
 class FileLength(ActiveRecord):
-  def populate(self, m):
-    print "Populate file length"
-    self.length = m[":file-length"] if ":file-length" in m else None
-    self.file_name = m[":file-name"] if ":file-name" in m else None
+  schema = [
+    (":file-length", "length", None),
+    (":file-name", "file_name", None)]
 
 class SourcePosition(ActiveRecord):
-  def populate(self, m):
-    self.file_name = m[":file"] if ":file" in m else None
-    self.line = m[":line"] if ":line" in m else None
-    self.length = m[":length"] if ":length" in m else None
+  schema = [
+    (":file", "file_name", None),
+    (":line", "line", None),
+    (":length", "length", None)]
 
 class Position(ActiveRecord):
-  def populate(self, m):
-    self.file_name = m[":file"] if ":file" in m else None
-    self.offset = m[":offset"] if ":offset" in m else None
-    self.start = m[":start"] if ":start" in m else None
-    self.end = m[":end"] if ":end" in m else None
+  lazy = True
+
+  schema = [
+    (":file", "file_name", None),
+    (":offset", "offset", None),
+    (":start", "start", None),
+    (":end", "end", None)]
 
 class Symbol(ActiveRecord):
+  lazy = True
+
   def populate(self, m):
     self.name = m[":name"]
     self.type = Type.parse(m[":type"])
@@ -95,6 +179,8 @@ class Symbol(ActiveRecord):
     self.owner_type_id = m[":owner-type-id"] if ":owner-type-id" in m else None
 
 class Type(ActiveRecord):
+  lazy = True
+
   def populate(self, m):
     self.name = m[":name"]
     self.type_id = m[":type-id"]
@@ -126,26 +212,32 @@ class SymbolSearchResults(ActiveRecord):
     self.results = SymbolSearchResult.parse_list(m)
 
 class SymbolSearchResult(ActiveRecord):
-  def populate(self, m):
-    self.name = m[":name"]
-    self.local_name = m[":local-name"]
-    self.decl_as = m[":decl-as"] if ":decl-as" in m else None
-    self.pos = Position.parse(m[":pos"]) if ":pos" in m else None
+  schema = [
+    (":name", "name"),
+    (":local-name", "local_name"),
+    (":decl-as", "decl_as", None),
+    (":pos", "pos", None, lambda raw: Position.parse(raw))]
 
 class RefactorResult(ActiveRecord):
   def populate(self, m):
     self.done = True
 
 class Member(ActiveRecord):
+  lazy = True
+
   def populate(self, m):
     pass
 
 class Params(ActiveRecord):
+  lazy = True
+
   def populate(self, m):
     self.is_implicit = bool(m[":is-implicit"]) if ":is-implicit" in m else False
     self.params = Param.parse_list(m[":params"]) if ":params" in m else []
 
 class Param(ActiveRecord):
+  lazy = True
+
   def populate(self, m):
     pass
 
@@ -199,53 +291,55 @@ class DebugKickoffResult(ActiveRecord):
       raise Exception("unexpected status: " + str(status))
 
 class DebugBacktrace(ActiveRecord):
-  def populate(self, m):
-    self.frames = DebugStackFrame.parse_list(m[":frames"]) if ":frames" in m else []
-    self.thread_id = m[":thread-id"]
-    self.thread_name = m[":thread-name"]
+  schema = [
+    (":frames", "frames", [], lambda raw: DebugStackFrame.parse_list(raw)),
+    (":thread-id", "thread_id"),
+    (":thread-name", "thread_name")]
 
 class DebugStackFrame(ActiveRecord):
-  def populate(self, m):
-    self.index = m[":index"]
-    self.locals = DebugStackLocal.parse_list(m[":locals"]) if ":locals" in m else []
-    self.num_args = m[":num-args"]
-    self.class_name = m[":class-name"]
-    self.method_name = m[":method-name"]
-    self.pc_location = DebugSourcePosition.parse(m[":pc-location"])
-    self.this_object_id = m[":this-object-id"]
+  schema = [
+    (":index", "index"),
+    (":locals", "locals", [], lambda raw: DebugStackLocal.parse_list(raw)),
+    (":num-args", "num_args"),
+    (":class-name", "class_name"),
+    (":method-name", "method_name"),
+    (":pc-location", "pc_location", REQUIRED, lambda raw: DebugSourcePosition.parse(raw)),
+    (":this-object-id", "this_object_id")]
 
 class DebugSourcePosition(ActiveRecord):
-  def populate(self, m):
-    self.file_name = m[":file"]
-    self.line = m[":line"]
+  schema = [
+    (":file", "file_name"),
+    (":line", "line")]
 
 class DebugStackLocal(ActiveRecord):
-  def populate(self, m):
-    self.index = m[":index"]
-    self.name = m[":name"]
-    self.summary = m[":summary"]
-    self.type_name = m[":type-name"]
+  schema = [
+    (":index", "index"),
+    (":name", "name"),
+    (":summary", "summary"),
+    (":type-name", "type_name")]
 
 class DebugValue(ActiveRecord):
-  def populate(self, m):
-    self.type = m[":val-type"]
-    self.type_name = m[":type-name"]
-    self.length = m[":length"] if ":length" in m else None
-    self.element_type_name = m[":element-type-name"] if ":element-type-name" in m else None
-    self.summary = m[":summary"] if ":summary" in m else None
-    self.object_id = m[":object-id"] if ":object-id" in m else None
-    self.fields = DebugObjectField.parse_list(m[":fields"]) if ":fields" in m else []
+  schema = [
+    (":val-type", "type"),
+    (":type-name", "type_name"),
+    (":length", "length", None),
+    (":element-type-name", "element_type_name", None),
+    (":summary", "summary", None),
+    (":object-id", "object_id", None),
+    (":fields", "fields", [], lambda raw: DebugObjectField.parse_list(raw))]
+
+  def validate(self):
     if str(self.type) == "null" or str(self.type) == "prim" or str(self.type) == "obj" or str(self.type) == "str" or str(self.type) == "arr":
       pass
     else:
-      raise Exception("unexpected debug value of type " + str(self.type) + ": " + str(m))
+      raise Exception("unexpected debug value of type " + str(self.type) + ": " + str(self))
 
 class DebugObjectField(ActiveRecord):
-  def populate(self, m):
-    self.index = m[":index"]
-    self.name = m[":name"]
-    self.summary = m[":summary"]
-    self.type_name = m[":type-name"]
+  schema = [
+    (":index", "index"),
+    (":name", "name"),
+    (":summary", "summary"),
+    (":type-name", "type_name")]
 
 class DebugLocation(ActiveRecord):
   def populate(self, m):
@@ -297,6 +391,189 @@ class DebugLocationSlot(DebugLocation):
   def unparse(self):
     return [[key(":type"), sym("slot"), key(":thread-id"), self.thread_id, key(":frame"), self.frame, key(":offset"), self.offset]]
 
+############################## REQUEST TABLE ##############################
+
+class PendingRequest(object):
+  __slots__ = ["msg_id", "method", "handler", "call_back_into_ui_thread", "time", "deadline", "frame", "sent", "connection"]
+
+  def __init__(self, msg_id, method, handler, call_back_into_ui_thread, req_time, deadline, frame):
+    self.msg_id = msg_id
+    self.method = method
+    self.handler = handler
+    self.call_back_into_ui_thread = call_back_into_ui_thread
+    self.time = req_time
+    self.deadline = deadline
+    self.frame = frame # kept around, so that the request can be replayed after a reconnect
+    self.sent = None # when the request has actually been written to the socket
+    self.connection = None # the socket it has been written to, so that we know what to replay when that one is lost
+
+# requests that can be safely sent twice, e.g. when we aren't sure whether the server has got them
+IDEMPOTENT_METHODS = set(["swank:typecheck-file", "swank:type-at-point", "swank:symbol-at-point"])
+
+# requests that only read from the server, so when it can't keep up, they can be shed and their callers get nothing back
+# the others (e.g. patch-source, typecheck-file or debug-set-break) change its state and are never dropped
+QUERY_METHODS = set(["swank:completions", "swank:type-at-point", "swank:symbol-at-point", "swank:import-suggestions",
+                     "swank:show-macros-in-file", "swank:expand-macro", "swank:file-length", "swank:get-file-length",
+                     "swank:debug-backtrace", "swank:debug-value", "swank:debug-to-string"])
+
+class RequestTable(object):
+  """Requests that have been sent to the server and haven't been replied to yet.
+  Every request has a deadline, after which it's reaped, and replies that arrive
+  after that (or to cancelled requests) are dropped. Reaping happens whenever a
+  request is added, so the table never outgrows the requests of the last timeout window."""
+
+  def __init__(self):
+    self._requests = {}
+    self._deadlines = [] # heap of (deadline, msg_id)
+    self._lock = threading.Lock()
+    self.timed_out = 0
+    self.cancelled = 0
+    self.dropped = 0
+
+  def __len__(self):
+    return len(self._requests)
+
+  def add(self, msg_id, method, handler, call_back_into_ui_thread, timeout, frame = None, now = None):
+    """Registers a request and returns the requests that have expired in the meanwhile."""
+    now = now or time.time()
+    self._lock.acquire()
+    try:
+      expired = self._reap(now)
+      self._requests[msg_id] = PendingRequest(msg_id, method, handler, call_back_into_ui_thread, now, now + timeout, frame)
+      heapq.heappush(self._deadlines, (now + timeout, msg_id))
+      return expired
+    finally:
+      self._lock.release()
+
+  def get(self, msg_id):
+    return self._requests.get(msg_id)
+
+  def pop(self, msg_id):
+    """Unregisters a request that has been replied to. Returns None for late or unknown replies."""
+    self._lock.acquire()
+    try:
+      req = self._requests.pop(msg_id, None)
+      if not req: self.dropped += 1
+      # replies leave their deadlines in the heap, so we compact it once it's mostly garbage
+      if len(self._deadlines) > 2 * len(self._requests) + 64:
+        self._deadlines = [(r.deadline, r.msg_id) for r in self._requests.itervalues()]
+        heapq.heapify(self._deadlines)
+      return req
+    finally:
+      self._lock.release()
+
+  def cancel(self, msg_id):
+    self._lock.acquire()
+    try:
+      req = self._requests.pop(msg_id, None)
+      if req: self.cancelled += 1
+      return req
+    finally:
+      self._lock.release()
+
+  def pending(self):
+    self._lock.acquire()
+    try:
+      return sorted(self._requests.values(), key = lambda req: req.msg_id)
+    finally:
+      self._lock.release()
+
+  def reap(self, now = None):
+    self._lock.acquire()
+    try:
+      return self._reap(now or time.time())
+    finally:
+      self._lock.release()
+
+  def _reap(self, now):
+    expired = []
+    while self._deadlines and self._deadlines[0][0] <= now:
+      deadline, msg_id = heapq.heappop(self._deadlines)
+      req = self._requests.get(msg_id)
+      if req and req.deadline == deadline:
+        del self._requests[msg_id]
+        expired.append(req)
+    self.timed_out += len(expired)
+    return expired
+
+  def clear(self):
+    """Forgets all requests and returns them, so that the caller can wake up whoever waits for them."""
+    self._lock.acquire()
+    try:
+      reqs = self._requests.values()
+      self._requests = {}
+      self._deadlines = []
+      return reqs
+    finally:
+      self._lock.release()
+
+  def stats(self):
+    return (str(len(self._requests)) + " outstanding, " + str(self.timed_out) + " timed out, " +
+            str(self.cancelled) + " cancelled, " + str(self.dropped) + " replies dropped")
+
+class BackgroundScheduler(object):
+  """Holds back background requests (e.g. typechecks triggered by opening files),
+  so that only a few of them are in flight at any moment, and interactive requests
+  don't get stuck behind a long queue on the server. A background request that's
+  still queued is replaced by a newer one with the same key (e.g. a typecheck of the same file)."""
+
+  def __init__(self, next_id, max_in_flight):
+    self._next_id = next_id
+    self.max_in_flight = max_in_flight
+    self._queue = [] # keys in order of submission
+    self._queued = {} # key -> function that sends the request under a given id
+    self._in_flight = set()
+    self._lock = threading.Lock()
+    self.deduplicated = 0
+
+  def __len__(self):
+    return len(self._queue)
+
+  def submit(self, key, send):
+    self._lock.acquire()
+    try:
+      if key in self._queued: self.deduplicated += 1
+      else: self._queue.append(key)
+      self._queued[key] = send
+    finally:
+      self._lock.release()
+    self._pump()
+
+  def done(self, msg_id):
+    self._lock.acquire()
+    try:
+      if not msg_id in self._in_flight: return
+      self._in_flight.remove(msg_id)
+    finally:
+      self._lock.release()
+    self._pump()
+
+  def _pump(self):
+    while True:
+      self._lock.acquire()
+      try:
+        if not self._queue or len(self._in_flight) >= self.max_in_flight: return
+        send = self._queued.pop(self._queue.pop(0))
+        # the id is marked in flight before the request goes out, so that a quick reply can't miss it
+        msg_id = self._next_id()
+        self._in_flight.add(msg_id)
+      finally:
+        self._lock.release()
+      send(msg_id)
+
+  def clear(self):
+    self._lock.acquire()
+    try:
+      self._queue = []
+      self._queued = {}
+      self._in_flight = set()
+    finally:
+      self._lock.release()
+
+  def stats(self):
+    return (str(len(self._in_flight)) + " background requests in flight, " + str(len(self._queue)) + " queued, " +
+            str(self.deduplicated) + " deduplicated")
+
 ############################## REMOTE PROCEDURES ##############################
 
 def _mk_req(func, *args, **kwargs):
@@ -326,8 +603,11 @@ def _mk_req(func, *args, **kwargs):
     req.extend(argreq)
   return req
 
-def async_rpc(*args):
+def async_rpc(*args, **kwargs):
   parser = args[0] if args else lambda raw: raw
+  # background requests are scheduled by the client behind interactive ones
+  # and deduplicated by the method and the first argument (usually, a file name)
+  background = kwargs.get("background", False)
   def wrapper(func):
     def wrapped(*args, **kwargs):
       self = args[0]
@@ -335,11 +615,18 @@ def async_rpc(*args):
         on_complete = args[-1]
         args = args[:-1]
       else: on_complete = None
+      # callers that aren't on the UI thread pass the timeout themselves, so that we don't touch the settings
+      timeout = kwargs.pop("timeout", None) or self.env.settings.get("timeout_" + func.__name__)
       req = _mk_req(func, *args, **kwargs)
       def callback(payload):
         data = parser(payload)
         if (on_complete): on_complete(data)
-      self.env.controller.client.async_req(req, callback, call_back_into_ui_thread = True)
+      background_key = (func.__name__, args[1] if len(args) > 1 else None) if background else None
+      return self.env.controller.client.async_req(req, callback, call_back_into_ui_thread = True, timeout = timeout,
+                                                  background_key = background_key)
+    # exposed for batches, which build requests themselves
+    wrapped.func = func
+    wrapped.parser = parser
     return wrapped
   return wrapper
 
@@ -352,30 +639,75 @@ def sync_rpc(*args):
       timeout = self.env.settings.get("timeout_" + func.__name__)
       raw = self.env.controller.client.sync_req(req, timeout = timeout)
       return parser(raw)
+    wrapped.func = func
+    wrapped.parser = parser
     return wrapped
   return wrapper
 
+class Batch(object):
+  """Collects calls to RPC methods and sends them to the server back to back in a single write,
+  so that N calls cost one round trip instead of N. Results come back all together, in the order of the calls.
+
+    batch = self.rpc.batch()
+    for i in range(n): batch.debug_value(DebugLocationElement(object_id, i))
+    values = batch.wait() # or batch.send(on_complete), which calls back into the UI thread
+
+  Calls that fail or time out yield None."""
+
+  def __init__(self, rpc):
+    self._rpc = rpc
+    self._calls = []
+
+  def __len__(self):
+    return len(self._calls)
+
+  def __getattr__(self, name):
+    method = getattr(type(self._rpc), name).im_func
+    if not hasattr(method, "func"): raise AttributeError(name + " is not a remote procedure")
+    def call(*args):
+      self._calls.append((_mk_req(method.func, self._rpc, *args), method.parser))
+    return call
+
+  def _timeout(self, timeout):
+    return timeout or self._rpc.env.settings.get("timeout_batch")
+
+  def _parse(self, payloads):
+    return [parser(payload) for ((_, parser), payload) in zip(self._calls, payloads)]
+
+  def wait(self, timeout = None):
+    reqs = map(lambda call: call[0], self._calls)
+    payloads = self._rpc.env.controller.client.batch_req(reqs, timeout = self._timeout(timeout))
+    return self._parse(payloads)
+
+  def send(self, on_complete, timeout = None):
+    reqs = map(lambda call: call[0], self._calls)
+    callback = lambda payloads: on_complete(self._parse(payloads))
+    self._rpc.env.controller.client.batch_req(reqs, callback, timeout = self._timeout(timeout))
+
 class Rpc(object):
   def __init__(self, env):
     self.env = env
 
+  def batch(self):
+    return Batch(self)
+
   @async_rpc()
   def init_project(self, conf): pass
 
   @sync_rpc()
   def shutdown_server(self): pass
 
-  @async_rpc()
+  @async_rpc(background = True)
   def typecheck_file(self, file_name): pass
 
   @async_rpc()
   def patch_source(self, file_name, edits): pass
 
-  @sync_rpc(Completion.parse_list)
+  @async_rpc(Completion.parse_list)
   def completions(self, file_name, position, max_results, case_sensitive, reload_from_disk): pass
 
   #Macros
-  @async_rpc(MacroMarkers.parse)
+  @async_rpc(MacroMarkers.parse, background = True)
   def show_macros_in_file(self, file_name): pass
 
   @async_rpc(MacroExpansion.parse)
@@ -443,39 +775,42 @@ class Rpc(object):
 
 
   def debug_start(self, launch, breakpoints, on_complete = None):
-    def set_breakpoints(breakpoints, status):
-      # gets the length of the file of interest
-      def callback(filelength):
+    # breakpoints are restored in two pipelined bursts (file lengths, then the breakpoints themselves)
+    # rather than one round trip per breakpoint
+    def launch_debugger(statuses):
+      if all(statuses):
+        if launch.main_class: self._debug_start(launch.command_line, on_complete)
+        elif launch.remote_address: self._debug_attach(launch.remote_host, launch.remote_port, on_complete)
+        else: raise Exception("unsupported launch: " + str(launch))
+      elif on_complete: on_complete(False)
+    def set_breakpoints(filelengths):
+      for filelength in filelengths:
         if filelength:
           self.env.file_lengths[filelength.file_name] = filelength.length
           print "file " + filelength.file_name + " is " + str(filelength.length)
-          set_breakpoints(breakpoints, status)
-      
-      if status:
-        if breakpoints:
-          # macro expansions can modify the positions of breakpoints. If we expand a macro - in the GUI and the gutter
-          # the breakpoints should and will be also modified. However these modified positions can't be send to the 
-          # server/debugger as such since the shown code in the buffer is not known to the debugger
-          bp = breakpoints[0]
-          if bp.file_name in self.env.file_lengths:
-            # often to be able to take into account the expanded code we must know the original length of the program
-            # if the length is not known we ask the server for it
-            bp_line = self._adapt_breakpoint(bp)
-            self.debug_set_break(bp.file_name, bp_line, bind(set_breakpoints, breakpoints[1:]))
-          else:
-            self.get_file_length(bp.file_name, callback)
-        else:
-          if launch.main_class: self._debug_start(launch.command_line, on_complete)
-          elif launch.remote_address: self._debug_attach(launch.remote_host, launch.remote_port, on_complete)
-          else: raise Exception("unsupported launch: " + str(launch))
-      elif on_complete: on_complete(status)
+      if not all(filelengths):
+        if on_complete: on_complete(False)
+        return
+      # macro expansions can modify the positions of breakpoints. If we expand a macro - in the GUI and the gutter
+      # the breakpoints should and will be also modified. However these modified positions can't be send to the
+      # server/debugger as such since the shown code in the buffer is not known to the debugger
+      batch = self.batch()
+      for bp in breakpoints:
+        batch.debug_set_break(bp.file_name, self._adapt_breakpoint(bp))
+      batch.send(launch_debugger)
+    def get_file_lengths():
+      # often to be able to take into account the expanded code we must know the original length of the program
+      batch = self.batch()
+      for file_name in sorted(set(map(lambda bp: bp.file_name, breakpoints))):
+        batch.get_file_length(file_name)
+      batch.send(set_breakpoints)
     def clear_breakpoints():
       def callback(status):
-        if status: set_breakpoints(breakpoints, status)
+        if status: get_file_lengths()
         elif on_complete: on_complete(status)
       self.debug_clear_all_breaks(callback)
 
-    self.env.file_lengths = dict([]) 
+    self.env.file_lengths = dict([])
     clear_breakpoints()
 
   @async_rpc()
@@ -500,4 +835,65 @@ class Rpc(object):
   def debug_to_string(self, thread_id, debug_location): pass
 
   @async_rpc(FileLength.parse)
-  def get_file_length(self, file_name): pass
\ No newline at end of file
+  def get_file_length(self, file_name): pass
+
+############################## SELF-CHECKS ##############################
+
+def _check_decoders():
+  # a broken nested record is reported as such, not as a malformed outer plist
+  try:
+    DebugStackFrame.parse(sexp.read('(:index 0 :locals ((:index 0 :name "args")) :num-args 1 :class-name "Main$" :method-name "main" :pc-location (:file "Main.scala" :line 5) :this-object-id "1")'))
+    assert False
+  except KeyError, e:
+    assert e.args == (":summary",), e
+  for raw in [sexp.read('(:msg "oops" :file)'), "oops"]:
+    try:
+      Note.parse(raw)
+      assert False
+    except Exception, e:
+      assert str(e).startswith("not a sexp"), e
+  # fields are decoded from what the server sends, including nested records, and missing ones get their defaults
+  frame = DebugStackFrame.parse(sexp.read('(:index 0 :locals ((:index 0 :name "args" :summary "Array[]" :type-name "java.lang.String[]")) :num-args 1 :class-name "Main$" :method-name "main" :pc-location (:file "Main.scala" :line 5) :this-object-id "1")'))
+  assert (frame.index, frame.num_args, frame.class_name, frame.method_name, frame.this_object_id) == (0, 1, "Main$", "main", "1")
+  assert [(l.index, l.name, l.summary, l.type_name) for l in frame.locals] == [(0, "args", "Array[]", "java.lang.String[]")]
+  assert (frame.pc_location.file_name, frame.pc_location.line) == ("Main.scala", 5)
+  completion = Completion.parse(sexp.read('(:name "foreach" :type-sig "Unit" :type-id 12)'))
+  assert completion.__dict__ == {"name": "foreach", "signature": "Unit", "is_callable": False, "type_id": 12, "to_insert": None}, completion
+  # defaults aren't shared between records
+  a, b = DebugValue.parse(sexp.read("(:val-type null :type-name \"Null\")")), DebugValue.parse(sexp.read("(:val-type null :type-name \"Null\")"))
+  assert a.fields == [] and not a.fields is b.fields
+
+def _check_request_table(days = 3, rate = 2):
+  # a few days of a session: a couple of requests per second, some of them never answered
+  table = RequestTable()
+  now = 0.0
+  for i in xrange(days * 24 * 3600 / 60):
+    for j in xrange(rate):
+      msg_id = i * rate + j
+      table.add(msg_id, "swank:type-at-point", None, False, 3, now = now)
+      if msg_id % 5: table.pop(msg_id)
+      elif msg_id % 10 == 0: table.cancel(msg_id)
+    now += 60
+  assert len(table) <= rate, len(table)
+  assert len(table._deadlines) <= 2 * rate + 64, len(table._deadlines)
+  print("request table after %d days: %s" % (days, table.stats()))
+
+def _check_background_scheduler():
+  ids = iter(xrange(1, 1000)).next
+  sent = []
+  scheduler = BackgroundScheduler(ids, 2)
+  # opening a dozen files at once, some of them twice
+  for name in ["A", "B", "C", "D", "C", "E", "D"]:
+    scheduler.submit(("typecheck_file", name + ".scala"), lambda msg_id, name = name: sent.append((msg_id, name)))
+  assert sent == [(1, "A"), (2, "B")], sent
+  assert len(scheduler) == 3 and scheduler.deduplicated == 2
+  scheduler.done(1)
+  scheduler.done(1) # late duplicate notifications are ignored
+  assert sent[-1] == (3, "C") and len(sent) == 3
+  for msg_id in [2, 3, 4]: scheduler.done(msg_id)
+  assert [name for _, name in sent] == ["A", "B", "C", "D", "E"], sent
+
+if __name__ == "__main__":
+  _check_background_scheduler()
+  _check_request_table()
+  _check_decoders()
@@ -0,0 +1,103 @@
+import os, re, json, zipfile, threading
+
+def read_manifest(jar_path):
+  jar = zipfile.ZipFile(jar_path, "r")
+  try:
+    return jar.read("META-INF/MANIFEST.MF")
+  finally:
+    jar.close()
+
+def parse_manifest(text):
+  manifest = {}
+  for line in text.splitlines():
+    if not line.strip(): continue
+    m = re.match(r"^(.*?):(.*)$", line)
+    # continuation lines of long values don't matter for us
+    if m: manifest[m.group(1).strip()] = m.group(2).strip()
+  return manifest
+
+def parse_version(s):
+  m = re.match(r"^(\d+)\.(\d+)(?:.(\d+)(?:.(\d+))?)?$", s)
+  if not m: raise ValueError("Problems parsing version: " + s)
+  return map(lambda s: int(s), filter(lambda s: s, m.groups()))
+
+class JarVersionCache(object):
+  """Remembers versions of server jars, so that startups don't have to unzip the jar
+  unless it has changed. An entry is keyed by the jar path and is valid as long as
+  the size and the modification time of the jar stay the same."""
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+
+  def _load(self):
+    try:
+      with open(self.path) as f: return json.load(f)
+    except (EnvironmentError, ValueError):
+      return {}
+
+  def lookup(self, jar_path):
+    """Returns the version of the jar if it has been verified before, otherwise None. Only stats the jar."""
+    try:
+      st = os.stat(jar_path)
+    except EnvironmentError:
+      return None
+    entry = self._load().get(os.path.abspath(jar_path))
+    if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+      return entry["version"]
+
+  def refresh(self, jar_path):
+    """Reads the version from the manifest of the jar and remembers it."""
+    st = os.stat(jar_path)
+    text = read_manifest(jar_path)
+    version = parse_manifest(text)["Implementation-Version"]
+    self._lock.acquire()
+    try:
+      entries = self._load()
+      entries[os.path.abspath(jar_path)] = {"size": st.st_size, "mtime": st.st_mtime, "version": version}
+      with open(self.path, "w") as f:
+        json.dump(entries, f, indent = 2, sort_keys = True)
+    finally:
+      self._lock.release()
+    return version
+
+def _make_jar(path, version, padding):
+  jar = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+  try:
+    jar.writestr("META-INF/MANIFEST.MF", "Manifest-Version: 1.0\r\nImplementation-Version: " + version + "\r\n\r\n")
+    # the real jar has thousands of classes, and their entries have to be read to find the manifest
+    for i in xrange(padding):
+      jar.writestr("org/ensime/Class" + str(i) + ".class", os.urandom(64))
+  finally:
+    jar.close()
+
+if __name__ == "__main__":
+  import tempfile, shutil, time
+  root = tempfile.mkdtemp()
+  try:
+    jar_path = os.path.join(root, "ensime_2.9.2-0.9.8.9.jar")
+    _make_jar(jar_path, "0.9.8.9", 5000)
+    cache = JarVersionCache(os.path.join(root, "jar_versions.json"))
+    assert cache.lookup(jar_path) is None
+    assert cache.refresh(jar_path) == "0.9.8.9"
+    assert cache.lookup(jar_path) == "0.9.8.9"
+    assert parse_version("0.9.8.9") > parse_version("0.9.8.6")
+    # an upgraded jar invalidates the entry
+    _make_jar(jar_path, "0.9.10", 10)
+    assert cache.lookup(jar_path) is None
+    assert cache.refresh(jar_path) == "0.9.10"
+    _make_jar(jar_path, "0.9.8.9", 5000)
+    cache.refresh(jar_path)
+
+    n = 50
+    started = time.time()
+    for i in xrange(n): parse_version(parse_manifest(read_manifest(jar_path))["Implementation-Version"])
+    uncached = (time.time() - started) / n
+    started = time.time()
+    for i in xrange(n): parse_version(cache.lookup(jar_path))
+    cached = (time.time() - started) / n
+    print "reading the manifest: %.2f ms" % (uncached * 1000)
+    print "cached lookup: %.2f ms" % (cached * 1000)
+    assert cached < uncached
+  finally:
+    shutil.rmtree(root)
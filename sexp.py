@@ -1,29 +1,37 @@
-import re
+import re, codecs
 
-class Keyword:
-  def __init__(self, s):
-    self.val = s
+class Atom(object):
+  """Atoms are interned: there's exactly one instance per name.
+  Therefore they are compared by identity, can be used as dict keys
+  and a message with thousands of identical keywords allocates just one object."""
+  __slots__ = ["val"]
+  def __new__(cls, s):
+    atom = cls._interned.get(s)
+    if atom is None:
+      atom = object.__new__(cls)
+      atom.val = s
+      atom = cls._interned.setdefault(s, atom)
+    return atom
   def __repr__(self):
     return self.val
-  def __eq__(self, k):
-    return type(k) == type(self) and self.val == k.val
+  def __reduce__(self):
+    return (type(self), (self.val,))
 
-class Symbol:
-  def __init__(self, s):
-    self.val = s
-  def __repr__(self):
-    return self.val
-  def __eq__(self, k):
-    return type(k) == type(self) and self.val == k.val
+class Keyword(Atom):
+  __slots__ = []
+  _interned = {}
+
+class Symbol(Atom):
+  __slots__ = []
+  _interned = {}
 
 def sexp_to_key_map(sexp):
     try:
-      key_type = type(key(":key"))
       result = {}
       for i in xrange(0, len(sexp), 2):
           k,val = sexp[i],sexp[i+1]
-          if type(k) == key_type:
-              result[str(k)] = val
+          if type(k) == Keyword:
+              result[k.val] = val
       return result
     except:
       raise Exception("not a sexp: %s" % sexp)
@@ -34,169 +42,284 @@ def key(s):
 def sym(s):
   return Symbol(s)
 
-def read(s):
-  "Read a sexp expression from a string."
-  return read_form(s)[0]
+def read(s, pool = None):
+  """Read a sexp expression from a string.
+  If a StringPool is provided, equal strings in the result share one object."""
+  return read_form(s, 0, pool)[0]
 
 def read_relaxed(s):
   """Read a sexp expression from a string.
   Unlike `read` this function allows ; comments
   and is more forgiving w.r.t whitespaces."""
-  lines = s.splitlines()
-  lines = map(lambda line: line.strip(), lines)
-  lines = filter(lambda line: line, lines)
-  lines = filter(lambda line: not line.startswith(";"), lines)
-  s = '\n'.join(lines)
-  return read_form(s)[0]
-
-def read_form(str):
-  "Read a form."
-  if len(str) == 0:
-    raise SyntaxError('unexpected EOF while reading form')
-  ch = str[0]
-  if ch.isspace():
-    raise SyntaxError('unexpected whitespace while reading form')
-  elif ch == '(':
-    return read_list(str)
-  elif ch == '"':
-    return read_string(str)
+  return read_form(s, 0, None, True)[0]
+
+class StringPool(object):
+  """A bounded pool that makes equal strings read from the server share one object.
+  Notes and completions repeat the same file names and type signatures thousands of times,
+  so pooling them saves memory and speeds up dict lookups keyed by them.
+  Strings are kept in two generations: when the young one fills up, the old one is dropped,
+  so the pool holds at most `capacity` strings and evicts the least recently used ones first."""
+
+  def __init__(self, capacity = 8192, max_length = 1024):
+    self.capacity = capacity
+    self.max_length = max_length
+    self._young = {}
+    self._old = {}
+
+  def intern(self, s):
+    if len(s) > self.max_length: return s
+    pooled = self._young.get(s)
+    if pooled is None:
+      pooled = self._old.get(s, s)
+      if len(self._young) >= self.capacity / 2:
+        self._old = self._young
+        self._young = {}
+      self._young[pooled] = pooled
+    return pooled
+
+# the reader walks a single cursor over the input instead of slicing it
+# after every character, so that reading a message is linear in its size
+_keyword_re = re.compile(r":(?:[^\W_]|-)*", re.UNICODE)
+_symbol_re = re.compile(r"(?:[^\W_]|[-:])+", re.UNICODE)
+_int_re = re.compile(r"(?:\d|-)+", re.UNICODE)
+_relaxed_space_re = re.compile(r"(?:\s+|;[^\r\n]*)*", re.UNICODE)
+
+def read_form(s, pos = 0, pool = None, relaxed = False):
+  """Read a form starting at s[pos].
+  In relaxed mode whitespace and ; comments are allowed anywhere between forms.
+  Return: (form, position right after the form)."""
+  n = len(s)
+  stack = []
+  while True:
+    if relaxed:
+      pos = _relaxed_space_re.match(s, pos).end()
+    if pos >= n:
+      raise SyntaxError('unexpected EOF while reading form')
+    if s[pos] == '(':
+      stack.append([])
+      pos += 1
+    else:
+      val, pos = read_atom(s, pos, pool)
+      if not stack:
+        return (val, pos)
+      stack[-1].append(val)
+    # we're inside a list: skip whitespace and close all lists that end here
+    while True:
+      if relaxed:
+        pos = _relaxed_space_re.match(s, pos).end()
+      while pos < n and s[pos].isspace():
+        pos += 1
+      if pos >= n:
+        raise SyntaxError('EOF while reading list')
+      if s[pos] != ')':
+        break
+      pos += 1
+      lst = stack.pop()
+      if not stack:
+        return (lst, pos)
+      stack[-1].append(lst)
+
+def read_atom(s, pos, pool = None):
+  """Read a non-list form starting at s[pos].
+  Return: (atom, position right after the atom)."""
+  ch = s[pos]
+  if ch == '"':
+    return read_string(s, pos, pool)
   elif ch == ':':
-    return read_keyword(str)
-  elif ch.isdigit() or ch == "-":
-    return read_int(str)
+    m = _keyword_re.match(s, pos)
+    if m.end() == len(s) and m.end() - pos <= 2:
+      raise SyntaxError('EOF while reading keyword')
+    return (Keyword(m.group()), m.end())
+  elif ch.isdigit() or ch == '-':
+    m = _int_re.match(s, pos)
+    # isdigit also accepts digits that aren't decimal (e.g. superscripts), and the regex doesn't
+    # the message is escaped, because exceptions with non-ascii messages can't be printed
+    if m is None:
+      raise SyntaxError('malformed int: ' + ch.encode('unicode_escape'))
+    try:
+      return (int(m.group()), m.end())
+    except ValueError:
+      raise SyntaxError('malformed int: ' + m.group().encode('unicode_escape'))
   elif ch.isalpha():
-    return read_symbol(str)
+    m = _symbol_re.match(s, pos)
+    val = m.group()
+    if val == "t":
+      return (True, m.end())
+    elif val == "nil":
+      return (False, m.end())
+    else:
+      return (Symbol(val), m.end())
   elif ch == '\'':
-    return read_atom(str)
+    return read_quoted(s, pos)
+  elif ch.isspace():
+    raise SyntaxError('unexpected whitespace while reading form')
   else:
     raise SyntaxError('unexpected character in read_form: ' + ch)
 
-def read_list(str):
-  "Read a list from a string."
-  if len(str) == 0:
-    raise SyntaxError('unexpected EOF while reading list')
-  if str[0] != '(':
-    raise SyntaxError('expected ( as first char of list: ' + str)
-  str = str[1:]
-  lst = []
-  while(len(str) > 0):
-    ch = str[0]
-    if ch.isspace():
-      str = str[1:]
-      continue
-    elif ch == ')':
-      return (lst,str[1:])
-    else:
-      val,remain = read_form(str)
-      lst.append(val)
-      str = remain
-  raise SyntaxError('EOF while reading list')
-
-def read_string(str):
-  "Read a string."
-  if len(str) == 0:
-    raise SyntaxError('unexpected EOF while reading string')
-  if str[0] != '"':
-    raise SyntaxError('expected ( as first char of string: ' + str)
-  str = str[1:]
-  s = ""
-  escaped = False
-  while(len(str) > 0):
-    ch = str[0]
-    if ch == '"' and not escaped:
-      return (s,str[1:])
-    elif escaped:
-      escaped = False
-      s = s[:-1] # remove the escaping backslash
-    elif ch == "\\":
-      escaped = True
-    s = s + ch
-    str = str[1:]
-  raise SyntaxError('EOF while reading string')
-
-def read_atom(str):
-  "Read an atom."
-  if len(str) == 0:
-    raise SyntaxError('unexpected EOF while reading atom')
-  if str[0] != '\'':
-    raise SyntaxError('expected \' as first char of atom: ' + str)
-  str = str[1:]
-  s = ""
-  while(len(str) > 0):
-    ch = str[0]
-    if ch.isspace():
-      return (s,str[1:])
-    s = s + ch
-    str = str[1:]
-  raise SyntaxError('EOF while reading atom')
-
-
-def read_keyword(str):
-  "Read a keyword."
-  if len(str) == 0:
-    raise SyntaxError('unexpected EOF while reading keyword')
-  if str[0] != ':':
-    raise SyntaxError('expected : as first char of keyword')
-  str = str[1:]
-  s = ""
-  while(len(str) > 0):
-    ch = str[0]
-    if not (ch.isalpha() or ch.isdigit() or ch == '-'):
-      return (Keyword(":" + s),str)
-    else:
-      s = s + ch
-      str = str[1:]
+def read_string(s, pos, pool = None):
+  """Read a string starting at s[pos].
+  A backslash makes the next character literal."""
+  if s[pos] != '"':
+    raise SyntaxError('expected " as first char of string')
+  pos += 1
+  end = s.find('"', pos)
+  if end == -1:
+    raise SyntaxError('EOF while reading string')
+  escape = s.find('\\', pos, end)
+  if escape == -1:
+    val = s[pos:end]
+    return (pool.intern(val) if pool else val, end + 1)
+  # slow path: copy the string chunk by chunk between escapes
+  chunks = []
+  while escape != -1:
+    if escape + 1 >= len(s):
+      raise SyntaxError('EOF while reading string')
+    chunks.append(s[pos:escape])
+    chunks.append(s[escape + 1])
+    pos = escape + 2
+    if end < pos:
+      end = s.find('"', pos)
+      if end == -1:
+        raise SyntaxError('EOF while reading string')
+    escape = s.find('\\', pos, end)
+  chunks.append(s[pos:end])
+  val = s[:0].join(chunks)
+  return (pool.intern(val) if pool else val, end + 1)
 
-  if len(s) > 1:
-    return (Keyword(":" + s),str)
-  else:
-    raise SyntaxError('EOF while reading keyword')
-
-
-def read_symbol(str):
-  "Read a symbol."
-  if len(str) == 0:
-    raise SyntaxError('unexpected EOF while reading symbol')
-  if not str[0].isalpha():
-    raise SyntaxError('expected alpha char as first char of symbol')
-  s = ""
-  while(len(str) > 0):
-    ch = str[0]
-    if not (ch.isalpha() or ch.isdigit() or ch == '-' or ch == ":"):
-      if s == "t":
-        return (True,str)
-      elif s == "nil":
-        return (False,str)
-      else:
-        return (Symbol(s),str)
-    else:
-      s = s + ch
-      str = str[1:]
+def read_quoted(s, pos):
+  "Read a quoted atom, which extends up to the next whitespace."
+  if s[pos] != '\'':
+    raise SyntaxError('expected \' as first char of atom')
+  end = pos + 1
+  n = len(s)
+  while end < n and not s[end].isspace():
+    end += 1
+  if end >= n:
+    raise SyntaxError('EOF while reading atom')
+  return (s[pos + 1:end], end + 1)
 
-  if len(s) > 0:
-    return (Symbol(s),str)
-  else:
-    raise SyntaxError('EOF while reading symbol')
-
-
-def read_int(str):
-  "Read an integer."
-  if len(str) == 0:
-    raise SyntaxError('unexpected EOF while reading int')
-  s = ""
-  while(len(str) > 0):
-    ch = str[0]
-    if not (ch.isdigit() or ch == '-'):
-      return (int(s),str)
+
+_delimiter_re = re.compile(r'[\s()"]', re.UNICODE)
+_space_re = re.compile(r'\s', re.UNICODE)
+
+class StreamReader(object):
+  """Reads forms from utf-8 encoded chunks as they arrive from the network.
+  Parse state (open lists, unfinished strings and atoms) is kept between calls
+  to `feed`, so parsing can start before the entire message has been received."""
+
+  def __init__(self, pool = None):
+    self.pool = pool
+    self.reset()
+
+  def reset(self):
+    self._undecoded = ""
+    self._stack = []
+    self._pending = u""
+    self._string = None
+    self._escaped = False
+
+  def feed(self, data, final = False):
+    """Consume the next chunk of bytes (a str or a zero-copy buffer over a bytearray).
+    `final` tells that no more data will arrive for the current message.
+    Return: a list of top-level forms completed by this chunk."""
+    try:
+      s = self._decode(data, final)
+      forms = []
+      pos = 0
+      if self._string is not None:
+        pos = self._read_string(s, 0, forms)
+      elif self._pending:
+        s = self._pending + s
+        self._pending = u""
+      self._read_forms(s, pos, final, forms)
+      if final and (self._stack or self._string is not None):
+        raise SyntaxError('unexpected EOF while reading form')
+      return forms
+    except:
+      self.reset()
+      raise
+
+  def _decode(self, data, final):
+    """Decode a chunk, carrying over an incomplete trailing utf-8 sequence to the next chunk.
+    Unlike codecs' incremental decoder this doesn't copy the chunk to prepend the carry-over."""
+    prefix = u""
+    if self._undecoded:
+      head = self._undecoded + str(buffer(data, 0, 4))
+      prefix, consumed = codecs.utf_8_decode(head, "strict", final)
+      skip = consumed - len(self._undecoded)
+      if skip < 0 or skip >= len(data):
+        self._undecoded = head[consumed:]
+        return prefix
+      data = buffer(data, skip)
+    s, consumed = codecs.utf_8_decode(data, "strict", final)
+    self._undecoded = str(buffer(data, consumed))
+    return prefix + s if prefix else s
+
+  def _emit(self, val, forms):
+    if self._stack:
+      self._stack[-1].append(val)
     else:
-      s = s + ch
-      str = str[1:]
+      forms.append(val)
 
-  if len(s) > 0:
-    return (int(s),str)
-  else:
-    raise SyntaxError('EOF while reading int')
+  def _read_forms(self, s, pos, final, forms):
+    n = len(s)
+    stack = self._stack
+    while pos < n:
+      ch = s[pos]
+      if ch.isspace():
+        pos += 1
+      elif ch == '(':
+        stack.append([])
+        pos += 1
+      elif ch == ')':
+        if not stack:
+          raise SyntaxError('unexpected ) while reading form')
+        self._emit(stack.pop(), forms)
+        pos += 1
+      elif ch == '"':
+        pos = self._read_string(s, pos + 1, forms)
+      else:
+        # quoted atoms end only at whitespace (see read_quoted), so parens and quotes don't delimit them
+        if not final and not (_space_re if ch == '\'' else _delimiter_re).search(s, pos):
+          # the atom might continue in the next chunk
+          self._pending = s[pos:]
+          return
+        val, pos = read_atom(s, pos, self.pool)
+        self._emit(val, forms)
 
+  def _read_string(self, s, pos, forms):
+    "Continue reading a string. Return: position after the string or len(s) if it's unfinished."
+    n = len(s)
+    chunks = self._string
+    if chunks is None:
+      end = s.find('"', pos)
+      if end != -1 and s.find('\\', pos, end) == -1:
+        val = s[pos:end]
+        self._emit(self.pool.intern(val) if self.pool else val, forms)
+        return end + 1
+      chunks = self._string = []
+    while pos < n:
+      if self._escaped:
+        chunks.append(s[pos])
+        self._escaped = False
+        pos += 1
+        continue
+      end = s.find('"', pos)
+      escape = s.find('\\', pos, n if end == -1 else end)
+      if escape != -1:
+        chunks.append(s[pos:escape])
+        self._escaped = True
+        pos = escape + 1
+      elif end == -1:
+        chunks.append(s[pos:])
+        pos = n
+      else:
+        chunks.append(s[pos:end])
+        self._string = None
+        val = u"".join(chunks)
+        self._emit(self.pool.intern(val) if self.pool else val, forms)
+        return end + 1
+    return n
 
 def to_string(exp):
   "Convert a Python object back into a Lisp-readable string."
@@ -210,21 +333,289 @@ def atom_to_str(exp):
     return "t"
   elif (not exp) and (type(exp) == type(False)):
     return "nil"
-  elif type(exp) == Symbol:
+  elif type(exp) == Symbol or type(exp) == Keyword:
     return exp.val
   elif isinstance(exp, basestring):
     return "\"" + exp.replace("\\", "\\\\").replace("\"", "\\\"") + "\""
   else:
     return str(exp)
 
+# protocol atoms (:swank-rpc, swank:completions, ...) are few and are sent over and over
+# therefore we cache their encoded form along with their length in characters
+_encoded_atoms = {}
+_max_encoded_atoms = 1024
+
+def _encode_atom(val):
+  encoded = _encoded_atoms.get(val)
+  if encoded is None:
+    encoded = (val.encode("utf-8") if isinstance(val, unicode) else val, len(val))
+    if len(_encoded_atoms) < _max_encoded_atoms: _encoded_atoms[val] = encoded
+  return encoded
+
+def _write(exp, out):
+  """Append the utf-8 representation of exp to the bytearray out.
+  Return: the length of the representation in characters."""
+  if isinstance(exp, list):
+    out += "("
+    chars = len(exp) + 1 if exp else 2
+    for i, elem in enumerate(exp):
+      if i: out += " "
+      chars += _write(elem, out)
+    out += ")"
+    return chars
+  elif type(exp) == bool:
+    out += "t" if exp else "nil"
+    return 1 if exp else 3
+  elif type(exp) == Symbol or type(exp) == Keyword:
+    encoded, chars = _encode_atom(exp.val)
+    out += encoded
+    return chars
+  elif isinstance(exp, basestring):
+    if isinstance(exp, str): exp = exp.decode("utf-8")
+    if "\\" in exp or "\"" in exp: exp = exp.replace("\\", "\\\\").replace("\"", "\\\"")
+    out += "\""
+    out += exp.encode("utf-8")
+    out += "\""
+    return len(exp) + 2
+  else:
+    s = str(exp)
+    out += s
+    return len(s)
+
+def to_frame(exp):
+  """Convert a Python object into a message ready to be sent to the server:
+  a six-digit hex length header followed by the utf-8 encoded form.
+  Note that the header counts characters, not bytes."""
+  out = bytearray("000000")
+  chars = _write(exp, out)
+  out[0:6] = "%06x" % chars
+  return str(out)
+
+# a compiled implementation of the codec (see _sexp_speedups.c for build instructions) can be put next to this file
+# its codec(Keyword, Symbol, read_form) function returns a pair of functions
+# with exactly the same semantics as read_form (including all optional arguments) and to_frame above
+# if there's no such module or it fails to load, we stay with pure Python, and fallback_reason tells why
+python_codec = (read_form, to_frame)
+fallback_reason = None
+try:
+  import _sexp_speedups
+  read_form, to_frame = _sexp_speedups.codec(Keyword, Symbol, read_form)
+  accelerated = True
+except ImportError, e:
+  accelerated = False
+  fallback_reason = "compiled codec is not available (" + str(e) + ")"
+except Exception, e:
+  accelerated = False
+  fallback_reason = "compiled codec is broken (" + type(e).__name__ + ": " + str(e) + ")"
+
 def repl(prompt='lis.py> '):
   "A prompt-read-eval-print loop."
   while True:
     val = eval(parse(raw_input(prompt)))
     if val is not None: print to_string(val)
 
+def _synthetic_notes(count):
+  "Mimics a :scala-notes batch produced by a full typecheck."
+  note = ("(:severity error :msg \"type mismatch;\\n found   : Int\\n required: \\\"String\\\"\" " +
+          ":beg %d :end %d :line %d :col 7 :file \"/home/user/project/src/main/scala/Module%d.scala\")")
+  notes = " ".join(note % (i * 10, i * 10 + 5, i, i % 50) for i in xrange(count))
+  return "(:scala-notes (:is-full t :notes (" + notes + ")))"
+
+# timing gates for `python sexp.py bench`
+# they are deliberately loose, because they are meant to catch asymptotic regressions
+# (e.g. going back to quadratic reading), not to benchmark the machine
+_bench_min_mb_per_second = 0.5
+_bench_max_superlinearity = 2.0
+
+def _bench_corpus(megabytes):
+  "A pinned corpus: synthetic notes plus a fixed pseudo-random mix of all kinds of forms."
+  import random
+  rng = random.Random(megabytes)
+  forms = to_string([_random_form(rng) for i in xrange(megabytes * 1000)])
+  notes = _synthetic_notes(1)
+  notes = _synthetic_notes(megabytes * 2**20 / len(notes)).decode("utf-8")
+  return [notes, forms]
+
+def _bench_timed(f, *args):
+  import time
+  start = time.time()
+  f(*args)
+  return max(time.time() - start, 1e-6)
+
+def _bench_read(megabytes = 4):
+  "Measures `read`, `StreamReader` and `to_frame` and fails if they are too slow or aren't linear."
+  def stream(s):
+    data = s.encode("utf-8")
+    reader = StreamReader(StringPool())
+    for i in xrange(0, len(data), 2**16): reader.feed(data[i:i + 2**16], final = i + 2**16 >= len(data))
+  def measure(corpus):
+    return [(name, sum(_bench_timed(f, s) for s in corpus))
+            for name, f in [("read", read), ("stream", stream), ("to_frame", lambda s: to_frame(read(s)))]]
+  small, large = _bench_corpus(megabytes / 4), _bench_corpus(megabytes)
+  small_size, large_size = sum(map(len, small)) / 2.0**20, sum(map(len, large)) / 2.0**20
+  for (name, small_time), (_, large_time) in zip(measure(small), measure(large)):
+    throughput = large_size / large_time
+    superlinearity = (large_time / small_time) / (large_size / small_size)
+    print("%s: %.1f MB in %.3f seconds (%.1f MB/s), %.1f MB in %.3f seconds, superlinearity %.2f" %
+      (name, large_size, large_time, throughput, small_size, small_time, superlinearity))
+    assert throughput >= _bench_min_mb_per_second, name + " is too slow"
+    assert superlinearity <= _bench_max_superlinearity, name + " doesn't scale linearly"
+
+def _check_stream(s, chunk_size):
+  "Feeds s to a StreamReader in chunks and makes sure it agrees with `read`."
+  data = s.encode("utf-8")
+  reader = StreamReader()
+  forms = []
+  for i in xrange(0, len(data), chunk_size):
+    forms += reader.feed(data[i:i + chunk_size], final = i + chunk_size >= len(data))
+  assert forms == [read(s)], (s, chunk_size, forms)
+
+def _check_frame(exp):
+  "Makes sure that `to_frame` agrees with `to_string`."
+  s = to_string(exp)
+  expected = "%06x" % len(s) + s
+  assert to_frame(exp) == expected.encode("utf-8"), (exp, to_frame(exp))
+
+_conformance_corpus = [
+  u"(:return (:ok (:pid nil :server-implementation (:name \"ENSIMEserver\") :machine nil :features nil :version \"0.0.1\")) 1)",
+  u"(:background-message 105 \"Initializing Analyzer. Please wait...\")",
+  u"(:compiler-ready t)",
+  u"(:notes ((:file \"C:\\\\src\\\\\\\"A\\\".scala\" :line -1 :msg \"\u0444\")))",
+  u"((((((nil))))))", u"()", u"(\"\")", u"(a b-c d:e 'quoted )"]
+
+def _outcome(f, *args):
+  "Either the result or the type and the message of the error."
+  try:
+    return (True, f(*args))
+  except Exception, e:
+    return (False, type(e), unicode(e))
+
+def _check_conformance(codec, rng, iterations):
+  "Makes sure that the given codec behaves exactly like the pure Python one, including errors."
+  read_form, to_frame = codec
+  py_read_form, py_to_frame = python_codec
+  def check(s, pool = None):
+    expected, actual = _outcome(py_read_form, s, 0, pool), _outcome(read_form, s, 0, pool)
+    assert expected[0] == actual[0] and (_same(expected[1:], actual[1:]) if expected[0] else expected == actual), (s, expected, actual)
+  for s in _conformance_corpus:
+    check(s)
+    check(s.encode("utf-8"))
+    form, pos = py_read_form(s)
+    assert to_frame(form) == py_to_frame(form), s
+  for s in [u"", u" ", u":", u":a", u"(:", u"(1 2", u"\"abc", u"\"a\\", u"'abc", u"\u00b2", u"--", u"1-2", u"123456789012345678901234567890",
+            u"\u0661\u0662", u"#", u"(a))", u"(\"a\\\"b\\\\\" c)", u"nil", u"t", u"tt", u"nils"]:
+    check(s)
+  # malformed ints are syntax errors in both codecs
+  for s in [u"(:a \u00b2)", u"-\u00b2", u"-\u0663-", u"--"]:
+    check(s)
+    assert _outcome(read_form, s)[:2] == (False, SyntaxError), s
+  for i in xrange(iterations):
+    form = _random_form(rng)
+    s = to_string(form)
+    check(s)
+    check(s, StringPool())
+    assert to_frame(form) == py_to_frame(form), form
+    mangled = list(s)
+    for j in xrange(rng.randint(1, 4)):
+      pos = rng.randint(0, max(len(mangled) - 1, 0))
+      mangled[pos:pos + rng.randint(0, 2)] = rng.choice([u"", u"(", u")", u"\"", u"\\", u":", u"-", u" ", u"'", u"1", u"\u00b2", u"\u0663"])
+    check(u"".join(mangled))
+  for exp in [[True, False, 1L, -5, 2**70, 1.5, u"\u0444\"\\", "\xd1\x84", key(":a"), sym("b")], "\xff"]:
+    assert _outcome(to_frame, exp)[:2] == _outcome(py_to_frame, exp)[:2], exp
+
+def _random_form(rng, depth = 0):
+  "Generates a random form that `to_string` can represent."
+  # the last two are digits that aren't ascii: a superscript two (not a decimal) and an arabic-indic three (a decimal)
+  alnum = u"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789\u0444\u00e9\u00b2\u0663"
+  def name(first):
+    return first + u"".join(rng.choice(alnum + u"-") for i in xrange(rng.randint(1, 8)))
+  kind = rng.randint(0, 9 if depth < 4 else 6)
+  if kind == 0: return rng.randint(-2**40, 2**40)
+  elif kind == 1: return u"".join(rng.choice(alnum + u" \\\"'()\n\t;:") for i in xrange(rng.randint(0, 20)))
+  elif kind == 2: return rng.choice([True, False])
+  elif kind == 3: return Keyword(name(u":" + rng.choice(alnum)))
+  elif kind == 4:
+    val = name(rng.choice(alnum[:52])) + rng.choice([u"", u":" + name(u"x")])
+    return Symbol(val)
+  elif kind in [5, 6]: return rng.choice([u"", u"\\", u"\"", u"\\\"", u"\u0444\"\\", u"b(c", u"foo\"bar", u"x)", u"'q"])
+  else: return [_random_form(rng, depth + 1) for i in xrange(rng.randint(0, 6))]
+
+def _same(a, b):
+  "Structural equality that doesn't confuse True with 1 or str with Symbol."
+  if type(a) == list and type(b) == list:
+    return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+  if type(a) in [int, long] and type(b) in [int, long]:
+    return a == b
+  return type(a) == type(b) and a == b
+
+def _render(rng, form):
+  "Like to_string, but writes some of the strings without whitespace as quoted atoms, which read back as the same strings."
+  if type(form) == list:
+    return u"(" + u" ".join([_render(rng, x) for x in form]) + u")"
+  if type(form) == unicode and form and not _space_re.search(form) and rng.randint(0, 1):
+    return u"'" + form + u" "
+  return to_string(form)
+
+def _check_roundtrip(rng, iterations):
+  "Checks that read(to_string(x)) == x on random forms, also when streamed in random chunks."
+  for i in xrange(iterations):
+    form = _random_form(rng)
+    s = to_string(form)
+    assert _same(read(s), form), (form, s)
+    assert _same(read(s, StringPool()), form), (form, s)
+    text = _render(rng, form)
+    assert _same(read(text), form), (form, text)
+    data = to_frame(form)[6:] if i % 2 else text.encode("utf-8")
+    reader = StreamReader()
+    forms = []
+    pos = 0
+    while pos < len(data):
+      chunk_size = rng.randint(1, 16)
+      forms += reader.feed(data[pos:pos + chunk_size], final = pos + chunk_size >= len(data))
+      pos += chunk_size
+    assert len(forms) == 1 and _same(forms[0], form), (form, forms)
+
+def _check_fuzz(rng, iterations):
+  "Checks that mangled messages are either read or rejected with a SyntaxError."
+  for i in xrange(iterations):
+    s = list(to_string([_random_form(rng) for j in xrange(3)]))
+    for j in xrange(rng.randint(1, 4)):
+      pos = rng.randint(0, len(s) - 1)
+      s[pos:pos + rng.randint(0, 2)] = rng.choice([u"", u"(", u")", u"\"", u"\\", u":", u"-", u" ", u"'", u"1", u"\u00b2", u"\u0663"])
+    s = u"".join(s)
+    try:
+      read(s)
+    except SyntaxError:
+      pass
+    try:
+      StreamReader().feed(s.encode("utf-8"), final = True)
+    except SyntaxError:
+      pass
 
 if __name__ == "__main__":
+  import sys, random
+  if "bench" in sys.argv[1:]:
+    _bench_read()
+    sys.exit(0)
+  rng = random.Random(42)
+  _check_roundtrip(rng, 2000)
+  _check_fuzz(rng, 2000)
+  for chunk_size in [1, 2, 3, 7, 1000]:
+    _check_stream(u"(:return (:ok (:name \"\u0444\\\"oo\" :type-id 12 :args (t nil 'a -3))) 42)", chunk_size)
+    _check_stream(u"(:notes ((:file \"a\\\\b\" :line 37)) \"\")", chunk_size)
+    _check_stream(u"swank:connection-info", chunk_size)
+    _check_stream(u"(:a \u0663 b\u00b2)", chunk_size)
+    _check_stream(u"(a 'b(c d)", chunk_size)
+    _check_stream(u"(:x 'foo\"bar baz)", chunk_size)
+  for s in [u"(:a \u00b2)", u"\u00b2", u"-\u00b2", u"(1 \u00b23)"]:
+    assert _outcome(read, s)[:2] == (False, SyntaxError), s
+    assert _outcome(StreamReader().feed, s.encode("utf-8"), True)[:2] == (False, SyntaxError), s
+  _check_frame([key(":swank-rpc"), [sym("swank:patch-source"), u"/src/\u0444.scala", [["+", 6227, u"a \"b\\"]]], 12])
+  _check_frame([[], True, False, -1, 7147L, "ascii"])
+  _check_conformance(python_codec, rng, 200)
+  if accelerated: _check_conformance((read_form, to_frame), rng, 5000)
+  else: print("skipped the conformance checks of the compiled codec: " + fallback_reason)
+  assert _same(read_relaxed(u"  ; header\n(:a-b 1 ;; trailing\n  \"x ; y\" ; c\n;(\n (t)) ; end"), [key(":a-b"), 1, u"x ; y", [True]])
   print(str(read("nil")))
   print(str(read("(\"a b c\")")))
   print(str(read("(a b c)")))
@@ -0,0 +1,145 @@
+import os, socket, subprocess
+
+# A transport knows how to open a connection to an Ensime server.
+# Connections are socket-like: they support recv_into, sendall, shutdown and close,
+# so the client doesn't care whether it talks over TCP, a Unix domain socket or a pipe.
+
+class Transport(object):
+  def connect(self, timeout):
+    raise Exception("abstract method: Transport.connect(self, timeout)")
+
+  def __str__(self):
+    raise Exception("abstract method: Transport.__str__(self)")
+
+class TcpTransport(Transport):
+  def __init__(self, port, host = "127.0.0.1"):
+    self.host = host
+    self.port = port
+
+  def connect(self, timeout):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    s.connect((self.host, self.port))
+    s.settimeout(None)
+    # requests are small and latency-sensitive, and the client coalesces them by itself
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return s
+
+  def __str__(self):
+    return "tcp:" + self.host + ":" + str(self.port)
+
+class UnixTransport(Transport):
+  def __init__(self, path):
+    if not hasattr(socket, "AF_UNIX"): raise Exception("Unix domain sockets aren't supported on this platform")
+    self.path = path
+
+  def connect(self, timeout):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    s.connect(self.path)
+    s.settimeout(None)
+    return s
+
+  def __str__(self):
+    return "unix:" + self.path
+
+class PipeConnection(object):
+  "Adapts a pair of pipes (e.g. stdout and stdin of a process) to the socket-like interface."
+  def __init__(self, reader, writer, proc = None):
+    self.reader = reader
+    self.writer = writer
+    self.proc = proc
+
+  def recv_into(self, buf):
+    data = os.read(self.reader.fileno(), len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+  def sendall(self, data):
+    self.writer.write(data)
+    self.writer.flush()
+
+  def shutdown(self, how):
+    try: self.writer.close()
+    except: pass
+    if self.proc and self.proc.poll() == None:
+      self.proc.terminate()
+
+  def close(self):
+    self.shutdown(socket.SHUT_RDWR)
+    try: self.reader.close()
+    except: pass
+
+class PipeTransport(Transport):
+  """Spawns a command and talks to it over its stdin and stdout.
+  Note that Ensime server itself only listens on TCP, so this is meant for bridges,
+  e.g. ["ssh", "build-box", "nc", "localhost", "4242"] for a server running on a remote machine."""
+  def __init__(self, command, cwd = None):
+    self.command = command
+    self.cwd = cwd
+
+  def connect(self, timeout):
+    proc = subprocess.Popen(self.command, stdin = subprocess.PIPE, stdout = subprocess.PIPE, cwd = self.cwd)
+    return PipeConnection(proc.stdout, proc.stdin, proc)
+
+  def __str__(self):
+    return "pipe:" + " ".join(self.command)
+
+class MemoryTransport(Transport):
+  """Connects to an in-process peer over a socket pair, which is handy for testing the client without a server.
+  The peer's end of the latest connection is available as server_end."""
+  def __init__(self):
+    self.server_end = None
+
+  def connect(self, timeout):
+    client_end, self.server_end = _socketpair()
+    return client_end
+
+  def __str__(self):
+    return "memory"
+
+def _socketpair():
+  if hasattr(socket, "socketpair"): return socket.socketpair()
+  # Windows doesn't have socketpair in Python 2, so we emulate it via loopback
+  listener = socket.socket()
+  try:
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client_end = socket.socket()
+    client_end.connect(listener.getsockname())
+    server_end, _ = listener.accept()
+    return client_end, server_end
+  finally:
+    listener.close()
+
+def from_settings(settings, port_file):
+  """Picks a transport for the server, whose TCP port has been written to port_file.
+  External servers can also be reached via a Unix domain socket or a bridge command."""
+  if settings.get("connect_to_external_server", False):
+    if settings.get("external_server_socket"): return UnixTransport(settings.get("external_server_socket"))
+    if settings.get("external_server_command"): return PipeTransport(settings.get("external_server_command"))
+  with open(port_file) as f: port = int(f.read())
+  return TcpTransport(port)
+
+def _check_transport(transport, server_end = None):
+  conn = transport.connect(1)
+  peer = server_end() if server_end else None
+  conn.sendall("000008(:ping)")
+  buf = bytearray(64)
+  received = 0
+  while received < 13:
+    if peer:
+      peer.sendall(peer.recv(64))
+    chunk = bytearray(64)
+    size = conn.recv_into(chunk)
+    buf[received:received + size] = chunk[:size]
+    received += size
+  assert str(buf[:received]) == "000008(:ping)", str(buf[:received])
+  conn.close()
+  if peer: peer.close()
+
+if __name__ == "__main__":
+  memory = MemoryTransport()
+  _check_transport(memory, lambda: memory.server_end)
+  if os.name != "nt":
+    _check_transport(PipeTransport(["cat"]))